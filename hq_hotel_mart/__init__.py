@@ -7,3 +7,5 @@ __copyright__     = 'Michal Grochmal (C) 2016'
 __license__       = 'GNU General Public License, version 3 or later'
 __url__           = 'https://github.com/grochmal/django-hq-hotel-mart'
 __date__          = '2016-07-28'
+
+default_app_config = 'hq_hotel_mart.apps.HqHotelMartConfig'
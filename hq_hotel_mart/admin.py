@@ -3,7 +3,11 @@ from . import models
 
 
 admin.site.register(models.Currency)
+admin.site.register(models.ExchangeRate)
 admin.site.register(models.Offer)
 admin.site.register(models.Hour)
 admin.site.register(models.HotelOffer)
-
+admin.site.register(models.HotelPresence)
+admin.site.register(models.ReloadCheckpoint)
+admin.site.register(models.Generation)
+admin.site.register(models.MartStat)
@@ -0,0 +1,52 @@
+import hashlib, math
+
+
+class BloomFilter(object):
+    '''
+    A plain Bloom filter over integers (hotel ids).  It never says an item is
+    missing when it was added, it may say an item is there when it was not
+    (with probability close to the false positive rate it was sized for).
+
+    The hashes are taken from md5 rather than hash() so that a filter built by
+    one process (the reload) answers the same in another (an API worker).
+    '''
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = max(8, size)
+        self.hashes = max(1, hashes)
+        nbytes = (self.size + 7) // 8
+        self.bits = bytearray(bits) if bits else bytearray(nbytes)
+        if len(self.bits) != nbytes:
+            raise ValueError('expected %i bytes of bits' % nbytes)
+
+    @classmethod
+    def for_items(cls, items, fp_rate):
+        '''
+        Sizes the filter for the items given and adds them all.
+        '''
+        items = list(items)
+        n = max(1, len(items))
+        size = int(math.ceil(-n * math.log(fp_rate) / (math.log(2) ** 2)))
+        hashes = int(round(size / float(n) * math.log(2)))
+        bloom = cls(size, hashes)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def positions(self, item):
+        # double hashing, two 64 bit halves of one digest give all k positions
+        digest = hashlib.md5(str(item).encode('ascii')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ (h1 + i * h2) % self.size for i in range(self.hashes) ]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all( self.bits[pos >> 3] & (1 << (pos & 7))
+                    for pos in self.positions(item) )
+
+    def to_bytes(self):
+        return bytes(self.bits)
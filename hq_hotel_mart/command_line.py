@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
-import os, sys, getopt, datetime, re
+import os, sys, getopt, datetime, re, random, itertools, json, time
+from decimal import Decimal
 from pytz import timezone
 
 # Importing static exceptions is alright, even before django.setup()
 from django.db import IntegrityError
+# And transaction only looks at the connections when a block is entered
+from django.db import transaction
+# So is importing modules that only touch settings when called
+from hq_hotel_mart import shards
+# And the sources, they touch the warehouse only once instantiated
+from hq_hotel_mart import sources
 
 
-# Trivial caches, used when we load several offers.
+# Trivial caches, used when we load several offers.  Both are keyed by the
+# database alias as well since every shard has its own ids.
 HOURS = {}
 CURRENCIES = {}
 
@@ -31,6 +39,16 @@ def settings_path():
              )
         sys.exit(1)
 
+def setup_django():
+    '''
+    Finds the project and sets django up.  It costs far more than anything
+    else in a quick call, therefore the commands parse their arguments (and
+    answer -h) before calling this.
+    '''
+    settings_path()
+    import django
+    django.setup()
+
 def dict_with_fields(org_dict, fields):
     new_dict = {}
     for f in fields:
@@ -40,14 +58,20 @@ def dict_with_fields(org_dict, fields):
             return {}
     return new_dict
 
-def save_object(params, model):
+def save_object(params, model, using=None):
     '''
     Save the object to the database whilst ignoring duplicates, i.e. if such an
     object is already there consider it to be the same one and return it.
+
+    `using` is the database alias (shard) to save into, None lets django pick.
+
+    The insert runs in a savepoint, within a batch of the reload a duplicate
+    rolls back only itself and not the whole transaction.
     '''
     try:
         obj = model(**params)
-        obj.save()
+        with transaction.atomic(using=shards.shard_db(using, model)):
+            obj.save(using=using)
         return obj
     except IntegrityError:
         # We may have hit a duplicate, check it further
@@ -65,57 +89,89 @@ def save_object(params, model):
             # Something horrible happened, fail
             return None
         try:
-            obj = model.objects.get(**uniq_params)
+            obj = model.objects.using(using).get(**uniq_params)
             # We have a duplicate, return it
             return obj
         except model.DoesNotExist:
             pass
     return None
 
-def load_currency(mmod, wmod, settings):
+def load_currency(mmod, source, settings):
     '''
-    This is a small table, just load it in full.
+    This is a small table, just load it in full.  Every shard gets a copy.
     '''
     global CURRENCIES
-    qs = wmod.Currency.objects.all()
-    for wcur in qs:
+    for wcur in source.currencies():
         params = { 'code' : wcur.code , 'name' : wcur.name }
-        currency = save_object(params, mmod.Currency)
-        if currency:
-            CURRENCIES[currency.code] = currency
-        yield params, currency
+        for alias in shards.shard_aliases():
+            currency = save_object(params, mmod.Currency, alias)
+            if currency:
+                CURRENCIES[(alias, currency.code)] = currency
+            yield params, currency
+    for p,rate in load_exchange_rate(mmod, source, settings):
+        yield p,rate
+
+def load_exchange_rate(mmod, source, settings):
+    '''
+    The rate of a currency is the sum of the original prices of its offers
+    over the sum of their prices in usd, an average weighted by price worked
+    out by a single GROUP BY in the warehouse (see Source.rate_sums).  Rates
+    move between reloads, therefore existing ones are updated instead of kept
+    as duplicates.
+    '''
+    rates = {}
+    for code, (original, usd) in source.rate_sums().items():
+        rate = Decimal(original) / Decimal(usd)
+        rates[code] = rate.quantize(Decimal('1e-10'))
+    if (shards.shard_aliases()[0], 'USD') in CURRENCIES:
+        # by definition, whether or not there are offers in usd
+        rates['USD'] = Decimal(1)
+    for code, per_usd in sorted(rates.items()):
+        params = { 'code' : code , 'per_usd' : per_usd }
+        for alias in shards.shard_aliases():
+            currency = CURRENCIES.get((alias, code))
+            if not currency:
+                # offers in a currency the warehouse does not list
+                yield params, None
+                continue
+            qs = mmod.ExchangeRate.objects.using(alias)
+            rate, created = qs.update_or_create(
+                currency=currency, defaults={ 'per_usd' : per_usd })
+            yield params, rate
 
-def get_hour(dt, mmod):
+def get_hour(dt, mmod, using=None):
     '''
     Small cache manager, seriously, we should be using redis for caches.
     '''
     global HOURS
-    if dt in HOURS:
-        return HOURS[dt]
+    if (using, dt) in HOURS:
+        return HOURS[(using, dt)]
     try:
-        hour = mmod.Hour.objects.get(day=dt.date(), hour=dt.time().hour)
+        hour = mmod.Hour.objects.using(using).get( day=dt.date()
+                                                 , hour=dt.time().hour )
     except mmod.Hour.DoesNotExist:
         # We should never get here!
         return None
-    HOURS[dt] = hour
+    HOURS[(using, dt)] = hour
     return hour
 
-def get_currency(wcur, mmod):
+def get_currency(code, mmod, using=None):
     '''
-    Cache for warehouse currency to mart currency conversion.
+    Cache for warehouse currency code to mart currency conversion.
     '''
     global CURRENCIES
-    if wcur.code in CURRENCIES:
-        return CURRENCIES[wcur.code]
+    if (using, code) in CURRENCIES:
+        return CURRENCIES[(using, code)]
     try:
-        mcur = mmod.Currency.objects.get(code=wcur.code)
+        mcur = mmod.Currency.objects.using(using).get(code=code)
     except mmod.Currency.DoesNotExist:
         # We should never get here!
         return None
-    CURRENCIES[mcur.code] = mcur
+    CURRENCIES[(using, mcur.code)] = mcur
     return mcur
 
-def load_hotel_offer(offer, days, date_fr, date_to, mmod, wmod, settings):
+def load_hotel_offer( offer, days, date_fr, date_to
+                    , mmod, source, settings, using=None):
     '''
     Build the cache of all offers within each hour.  This will make API
     queries trivial (and quick :) ).
@@ -125,96 +181,268 @@ def load_hotel_offer(offer, days, date_fr, date_to, mmod, wmod, settings):
     # The end timestamp is already shifted on hour forward,
     # therefore we will alway use an inclusive between.
     while curr < date_to:
-        hour = get_hour(curr, mmod)
+        hour = get_hour(curr, mmod, using)
         if not hour:
+            # removed (hqm-roll) since the reload read the range of hours
             yield None,None
+            curr += dl
             continue
-        params = { 'hour'     : hour
-                 , 'hotel_id' : offer.hotel_id
-                 , 'days'     : days
-                 , 'offer_id' : offer
+        params = { 'generation'   : offer.generation
+                 , 'hour'         : hour
+                 , 'hour_key'     : hour.key
+                 , 'hotel_id'     : offer.hotel_id
+                 , 'days'         : days
+                 , 'checkin_date' : offer.checkin_date
+                 , 'offer_id'     : offer
                  }
-        hotel_offer = save_object(params, mmod.HotelOffer)
+        hotel_offer = save_object(params, mmod.HotelOffer, using)
         yield params, hotel_offer
         curr += dl
 
-def load_offer(mmod, wmod, settings):
+def load_offer( mmod, source, settings, generation
+              , after=0, chunk=1000, checkpoint=None):
     '''
     We only care about the offers that are within the years loaded in the mart,
     older or newer offers are simply ignored.  Once time advances we will need
     to reload the mart with new data, whilst throwing old data away (the data
     is in the warehouse anyway).
+
+    Each offer, and its hour cache, goes to the shard of its hotel, into
+    `generation`.
+
+    The offers of the source are walked in id order, in chunks.  Each chunk is
+    loaded in a single transaction on every shard, and `checkpoint` is called
+    with the id of its last offer before that transaction commits.  A reload
+    can then be resumed from there by passing that id as `after`.
     '''
-    first_date = mmod.Hour.objects.all().order_by('day', 'hour').first()
-    last_date = mmod.Hour.objects.all().order_by('day', 'hour').last()
+    # All shards hold the same hours, any of them will do
+    hours = mmod.Hour.objects.using(shards.shard_aliases()[0])
+    first_date = hours.order_by('day', 'hour').first()
+    last_date = hours.order_by('day', 'hour').last()
     if not first_date or not last_date:
         # No dates loaded!  Go load them.
         yield None, None
+        return
     df = datetime.datetime.combine( first_date.day
                                   , datetime.time(hour=first_date.hour ) )
     dt = datetime.datetime.combine( last_date.day
                                   , datetime.time(hour=last_date.hour ) )
     # consider the last hour to be always in range
     dt += datetime.timedelta(hours=1)
-    for offer in wmod.ValidOffer.objects.filter(invalid=False):
-        ofdatef = datetime.datetime.combine( offer.valid_from_date
-                                           , offer.valid_from_time )
-        ofdatet = datetime.datetime.combine( offer.valid_to_date
-                                           , offer.valid_to_time )
-        if df > ofdatet or dt < ofdatef:
-            # offer too old or too into the future
-            continue
-        days_delta = offer.checkout_date - offer.checkin_date
-        days = days_delta.days
-        if 0 >= days:
-            # This is an offer of purely statistical value, no need to be here.
-            # Maybe we should invalidate these cases in the warehouse already?
-            # It would be slightly faster that way.
-            continue
-        date_fr = ofdatef
-        if ofdatef < df:
-            date_fr = df
-        date_to = ofdatet + datetime.timedelta(hours=1)
-        if ofdatet > dt:
-            date_to = dt
-        # we need to add the fields by hand because the warehouse
-        # has extra housekeeping data in the models
-        mcurrency = get_currency(offer.original_currency, mmod)
-        offer_params = { 'hotel_id'           : offer.hotel_id
-                       , 'price_usd'          : offer.price_usd
-                       , 'original_price'     : offer.original_price
-                       , 'original_currency'  : mcurrency
-                       , 'breakfast_included' : offer.breakfast_included
-                       , 'valid_from_date'    : offer.valid_from_date
-                       , 'valid_to_date'      : offer.valid_to_date
-                       , 'valid_from_time'    : offer.valid_from_time
-                       , 'valid_to_time'      : offer.valid_to_time
-                       , 'checkin_date'       : offer.checkin_date
-                       , 'checkout_date'      : offer.checkout_date
-                       }
-        mart_offer = save_object(offer_params, mmod.Offer)
-        if not mart_offer:
-            yield offer_params, mart_offer
-            continue
-        else:
-            yield offer_params, mart_offer
-        # We have an offer saved to the database, make the hour cache
-        for p,hotel_hour in load_hotel_offer( mart_offer
-                                            , days
-                                            , date_fr
-                                            , date_to
-                                            , mmod
-                                            , wmod
-                                            , settings
-                                            ):
-            yield p,hotel_hour
-
-def mart_load_tables(mmod, wmod, settings):
-    for p,cur in load_currency(mmod, wmod, settings):
-        yield p,cur
-    for p,offer in load_offer(mmod, wmod, settings):
+    for offer_chunk in source.offer_chunks(after, chunk):
+        with shards.atomic_shards():
+            for offer in offer_chunk:
+                for p,obj in load_one_offer( offer, df, dt, generation
+                                           , mmod, source, settings ):
+                    yield p,obj
+            after = offer_chunk[-1].pk
+            if checkpoint:
+                checkpoint(after)
+
+def load_one_offer(offer, df, dt, generation, mmod, source, settings):
+    ofdatef = datetime.datetime.combine( offer.valid_from_date
+                                       , offer.valid_from_time )
+    ofdatet = datetime.datetime.combine( offer.valid_to_date
+                                       , offer.valid_to_time )
+    if df > ofdatet or dt < ofdatef:
+        # offer too old or too into the future
+        return
+    days_delta = offer.checkout_date - offer.checkin_date
+    days = days_delta.days
+    if 0 >= days:
+        # This is an offer of purely statistical value, no need to be here.
+        # Maybe we should invalidate these cases in the warehouse already?
+        # It would be slightly faster that way.
+        return
+    date_fr = ofdatef
+    if ofdatef < df:
+        date_fr = df
+    date_to = ofdatet + datetime.timedelta(hours=1)
+    if ofdatet > dt:
+        date_to = dt
+    alias = shards.shard_for(offer.hotel_id)
+    # we need to add the fields by hand because the warehouse
+    # has extra housekeeping data in the models
+    mcurrency = get_currency(offer.currency_code, mmod, alias)
+    offer_params = { 'generation'         : generation
+                   , 'hotel_id'           : offer.hotel_id
+                   , 'price_usd'          : offer.price_usd
+                   , 'original_price'     : offer.original_price
+                   , 'original_currency'  : mcurrency
+                   , 'breakfast_included' : offer.breakfast_included
+                   , 'valid_from_date'    : offer.valid_from_date
+                   , 'valid_to_date'      : offer.valid_to_date
+                   , 'valid_from_time'    : offer.valid_from_time
+                   , 'valid_to_time'      : offer.valid_to_time
+                   , 'checkin_date'       : offer.checkin_date
+                   , 'checkout_date'      : offer.checkout_date
+                   }
+    mart_offer = save_object(offer_params, mmod.Offer, alias)
+    yield offer_params, mart_offer
+    if not mart_offer:
+        return
+    # We have an offer saved to the database, make the hour cache
+    for p,hotel_hour in load_hotel_offer( mart_offer
+                                        , days
+                                        , date_fr
+                                        , date_to
+                                        , mmod
+                                        , source
+                                        , settings
+                                        , alias
+                                        ):
+        yield p,hotel_hour
+
+def mart_load_tables( mmod, source, settings, generation
+                    , after=0, chunk=1000, checkpoint=None):
+    with shards.atomic_shards():
+        for p,cur in load_currency(mmod, source, settings):
+            yield p,cur
+    for p,offer in load_offer( mmod, source, settings, generation
+                             , after, chunk, checkpoint ):
         yield p,offer
 
+def generation_next(mmod):
+    '''
+    A generation number above any the mart has seen, the same on all shards.
+    '''
+    from django.db.models import Max
+
+    return 1 + max( mmod.Generation.objects.using(alias)
+                        .aggregate(number=Max('number'))['number'] or 0
+                    for alias in shards.shard_aliases() )
+
+def generation_start(mmod, generation):
+    for alias in shards.shard_aliases():
+        mmod.Generation.objects.using(alias).get_or_create(number=generation)
+
+def generation_publish(mmod, generation):
+    '''
+    The pointer flip: the API reads `generation` from now on, or once the
+    generation cached by a worker expires (HQ_MART_GENERATION_TTL).  One
+    transaction over all shards.
+    '''
+    from django.utils.timezone import now
+
+    with shards.atomic_shards():
+        for alias in shards.shard_aliases():
+            qs = mmod.Generation.objects.using(alias).filter(number=generation)
+            qs.update(published=now())
+
+def checkpoint_start(mmod, resume, unsafe=False):
+    '''
+    Returns the warehouse offer id to continue after (0 for a reload from the
+    beginning), the generation to load into and whether the reload runs with
+    the hour cache indexes dropped, or None when asked to resume but there is
+    nothing to resume.  A resumed reload is unsafe if the one it continues
+    was, its indexes are still missing.  A reload from the beginning starts a
+    new generation.  The checkpoint lives in the first shard only.
+    '''
+    using = shards.shard_aliases()[0]
+    qs = mmod.ReloadCheckpoint.objects.using(using)
+    last = qs.filter(name='offers').first()
+    if resume:
+        if not last or last.finished:
+            return None
+        generation_start(mmod, last.generation)
+        return last.last_offer_id, last.generation, last.unsafe
+    generation = generation_next(mmod)
+    generation_start(mmod, generation)
+    qs.filter(name='offers').delete()
+    mmod.ReloadCheckpoint( name='offers'
+                         , last_offer_id=0
+                         , generation=generation
+                         , unsafe=unsafe
+                         ).save(using=using)
+    return 0, generation, unsafe
+
+def checkpoint_save(mmod, offer_id, finished=False):
+    from django.utils.timezone import now
+
+    using = shards.shard_aliases()[0]
+    qs = mmod.ReloadCheckpoint.objects.using(using).filter(name='offers')
+    qs.update(last_offer_id=offer_id, finished=finished, updated=now())
+
+def hotel_offer_indexes(mmod, drop, using=None):
+    '''
+    Drops, or creates back, the plain (not unique) indexes of the hour cache.
+    Maintaining them row by row costs more than building them once after a
+    bulk load.  The unique index stays, the reload needs it to find duplicates.
+
+    Dropping an index that is already gone (e.g. left so by a killed unsafe
+    reload) is not an error, they are all created again afterwards anyway.
+    '''
+    from django.db import connections
+
+    model = mmod.HotelOffer
+    indexes = [ tuple(fields) for fields in model._meta.index_together ]
+    with connections[shards.shard_db(using, model)].schema_editor() as editor:
+        if not drop:
+            editor.alter_index_together(model, set(), set(indexes))
+            return
+        for fields in indexes:
+            try:
+                editor.alter_index_together(model, set([ fields ]), set())
+            except ValueError:
+                # no such index
+                pass
+
+def mart_build_presence( fp_rate, batch, mmod, generation
+                       , using=None, histogram=None):
+    '''
+    Builds the Bloom filter of the hotels present in each hour of a generation,
+    from a single ordered walk over the (generation, hour, hotel_id) index of
+    the hour cache.  Every hour gets a filter, an empty one when no hotel has
+    offers in it.  The number of rows of each (hour, hotel_id) pair is added
+    to `histogram`, if given.
+
+    Yields the number of filters saved by each bulk insert.
+    '''
+    from django.db.models import Count
+    from hq_hotel_mart.bloom import BloomFilter
+
+    pairs = ( mmod.HotelOffer.objects.using(using)
+                  .filter(generation=generation)
+                  .values_list('hour', 'hotel_id')
+                  .annotate(rows=Count('pk'))
+                  .order_by('hour', 'hotel_id')
+                  .iterator() )
+    # Both walks are ordered by hour id, merge them one hour at a time so we
+    # never hold more than the hotels of a single hour.
+    by_hour = itertools.groupby(pairs, key=lambda p: p[0])
+    current = next(by_hour, None)
+    hour_ids = ( mmod.Hour.objects.using(using)
+                     .order_by('pk')
+                     .values_list('pk', flat=True) )
+    presence = mmod.HotelPresence.objects.using(using)
+    presence.filter(generation=generation).delete()
+    filters = []
+    for hour_id in hour_ids:
+        hotels = []
+        while current and current[0] <= hour_id:
+            if current[0] == hour_id:
+                hotels = []
+                for h,hotel_id,rows in current[1]:
+                    hotels.append(hotel_id)
+                    if histogram:
+                        histogram.add(rows)
+            current = next(by_hour, None)
+        bloom = BloomFilter.for_items(hotels, fp_rate)
+        filters.append(mmod.HotelPresence( generation=generation
+                                         , hour_id=hour_id
+                                         , hotels=len(hotels)
+                                         , size=bloom.size
+                                         , hashes=bloom.hashes
+                                         , bits=bloom.to_bytes()
+                                         ))
+        if len(filters) >= batch:
+            mmod.HotelPresence.objects.using(using).bulk_create(filters)
+            yield len(filters)
+            filters = []
+    if filters:
+        mmod.HotelPresence.objects.using(using).bulk_create(filters)
+        yield len(filters)
+
 def mart_load_year(year, mmod, wmod, settings):
     '''
     Don't bother checking if we already have this year in the database, we will
@@ -232,29 +460,251 @@ def mart_load_year(year, mmod, wmod, settings):
         yield curr
         curr += dl
 
-def reload_mart():
+def mart_window(df, dt):
     '''
-    Scrutinise the parameters, and takes data from the warehouse.  Most of the
-    time we will want to ignore duplicates and add new rows, but, from time to
-    time, it is useful to truncate the tables in the mart to reduce the number
-    of rows.
+    Every hour from df (inclusive) to dt (exclusive).
     '''
-    settings_path()
-    import django
-    django.setup()
-    from django.conf import settings
-    from hq_warehouse import models as wmod
-    from hq_hotel_mart import models as mmod
+    dl = datetime.timedelta(hours=1)
+    curr = df.replace(minute=0, second=0, microsecond=0)
+    while curr < dt:
+        yield curr
+        curr += dl
+
+def mart_add_hours(df, dt, batch, mmod, using=None):
+    '''
+    Adds the hours of the window that are not in the mart yet, together with
+    their hour cache.  Unlike mart_load_year we do check what is there already,
+    a rolling window is moved forward often and most of its hours are always
+    there.
+
+    Every batch of hours is inserted in one transaction with its hour cache,
+    a roll killed half way leaves no hour without it.
+
+    Yields the model and the number of rows inserted by each bulk insert.
+    '''
+    hours = mmod.Hour.objects.using(using)
+    known = set(hours.filter(day__gte=df.date(), day__lte=dt.date())
+                     .values_list('day', 'hour'))
+    missing = [ mmod.Hour(day=h.date(), hour=h.time().hour)
+                for h in mart_window(df, dt)
+                if (h.date(), h.time().hour) not in known ]
+    for i in range(0, len(missing), batch):
+        added = missing[i:i+batch]
+        with transaction.atomic(using=shards.shard_db(using, mmod.Hour)):
+            hours.bulk_create(added)
+            yield mmod.Hour, len(added)
+            for rows in mart_fill_hours(added, batch, mmod, using):
+                yield mmod.HotelOffer, rows
+
+def mart_fill_hours(added, batch, mmod, using=None):
+    '''
+    Builds the hour cache of newly added hours, in every generation, from the
+    offers of the mart valid in them.  The offers carry their validity, the
+    warehouse is not needed.  An offer is in the cache of every hour its
+    validity overlaps, as the reload puts it for validities in whole hours.
+    Offers the last reload skipped, valid only after the window it loaded,
+    are not in the mart and come with the next reload.  Neither do warehouse
+    offers merged into one mart offer (same hotel, dates and breakfast): the
+    mart offer keeps the validity of the first of them.
+
+    One query for the ids of the hours and one per day and generation for the
+    offers.  Yields the number of rows inserted by each bulk insert.
+    '''
+    if not added:
+        return
+    dl = datetime.timedelta(hours=1)
+    first = min(h.day for h in added)
+    last = max(h.day for h in added)
+    # bulk_create does not give us the ids on every database
+    ids = dict( (mmod.hour_key(day, hour), pk)
+                for pk, day, hour in mmod.Hour.objects.using(using)
+                    .filter(day__gte=first, day__lte=last)
+                    .values_list('pk', 'day', 'hour') )
+    by_day = {}
+    for h in added:
+        start = datetime.datetime.combine(h.day, datetime.time(h.hour))
+        by_day.setdefault(h.day, []).append((start, h.key, ids[h.key]))
+    generations = mmod.Generation.objects.using(using)
+    rows = []
+    for generation in generations.values_list('number', flat=True):
+        for day, day_hours in sorted(by_day.items()):
+            offers = ( mmod.Offer.objects.using(using)
+                           .filter( generation=generation
+                                  , valid_from_date__lte=day
+                                  , valid_to_date__gte=day )
+                           .values_list( 'pk'
+                                       , 'hotel_id'
+                                       , 'valid_from_date'
+                                       , 'valid_from_time'
+                                       , 'valid_to_date'
+                                       , 'valid_to_time'
+                                       , 'checkin_date'
+                                       , 'checkout_date'
+                                       ) )
+            for ( pk, hotel_id, from_date, from_time, to_date, to_time
+                , checkin, checkout ) in offers.iterator():
+                valid_from = datetime.datetime.combine(from_date, from_time)
+                valid_to = datetime.datetime.combine(to_date, to_time)
+                for start, key, hour_id in day_hours:
+                    if valid_from >= start + dl or valid_to < start:
+                        continue
+                    rows.append(mmod.HotelOffer( generation=generation
+                                               , hour_id=hour_id
+                                               , hour_key=key
+                                               , hotel_id=hotel_id
+                                               , days=(checkout - checkin).days
+                                               , checkin_date=checkin
+                                               , offer_id_id=pk
+                                               ))
+                    if len(rows) >= batch:
+                        mmod.HotelOffer.objects.using(using).bulk_create(rows)
+                        yield len(rows)
+                        rows = []
+    if rows:
+        mmod.HotelOffer.objects.using(using).bulk_create(rows)
+        yield len(rows)
+
+def mart_expire_hours(df, batch, mmod, using=None):
+    '''
+    Removes the hours before df together with their hour cache, and the offers
+    that are not valid in any remaining hour.  Everything is deleted in small
+    batches, each in its own transaction, so that the API (reading the same
+    tables) never waits long for a lock.
+
+    Yields the model and the number of rows removed by each delete.
+    '''
+    from django.db.models import Q
+
+    # the hour cache first, a range of hour keys walked along the API index
+    # of every generation
+    cache = mmod.HotelOffer.objects.using(using)
+    key = mmod.hour_key(df.date(), df.hour)
+    generations = mmod.Generation.objects.using(using)
+    for generation in generations.values_list('number', flat=True):
+        expired = cache.filter(generation=generation, hour_key__lt=key)
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:batch])
+            if not ids:
+                break
+            cache.filter(pk__in=ids).delete()
+            yield mmod.HotelOffer, len(ids)
+    expired = mmod.Hour.objects.using(using).filter(
+          Q(day__lt=df.date())
+        | Q(day=df.date(), hour__lt=df.time().hour)
+        )
+    hour_ids = list(expired.values_list('pk', flat=True))
+    for i in range(0, len(hour_ids), batch):
+        ids = hour_ids[i:i+batch]
+        mmod.Hour.objects.using(using).filter(pk__in=ids).delete()
+        yield mmod.Hour, len(ids)
+    offers = mmod.Offer.objects.using(using).filter(
+          valid_to_date__lte=df.date()
+        , offer_hours__isnull=True
+        )
+    while True:
+        ids = list(offers.values_list('pk', flat=True)[:batch])
+        if not ids:
+            break
+        mmod.Offer.objects.using(using).filter(pk__in=ids).delete()
+        yield mmod.Offer, len(ids)
+
+def mart_collect_generations(before, batch, mmod, using=None, pause=0):
+    '''
+    Removes the generations older than the newest one published before
+    `before`, published or not (a reload that was abandoned).  Workers may
+    still read the generation published before the current one for a while,
+    `before` must leave them that time.  Rows are deleted in small batches,
+    each in its own transaction, with a `pause` in seconds after each so that
+    the API gets the database first.
+
+    Yields the model and the number of rows removed by each delete.
+    '''
+    generations = mmod.Generation.objects.using(using)
+    settled = ( generations.filter(published__lte=before)
+                           .order_by('-number')
+                           .first() )
+    if not settled:
+        return
+    # children first, deleting an offer would otherwise collect its hours
+    for model in (mmod.HotelPresence, mmod.HotelOffer, mmod.Offer):
+        rows = model.objects.using(using)
+        old = rows.filter(generation__lt=settled.number)
+        while True:
+            ids = list(old.values_list('pk', flat=True)[:batch])
+            if not ids:
+                break
+            rows.filter(pk__in=ids).delete()
+            yield model, len(ids)
+            time.sleep(pause)
+    old = generations.filter(number__lt=settled.number)
+    removed = old.count()
+    if removed:
+        old.delete()
+        yield mmod.Generation, removed
 
-    usage = 'hqm-reload [-hvt]'
+def collect_stats(collectors, obj, mmod):
+    '''
+    Feeds an object saved by the reload to the statistics of its shard.
+    '''
+    from hq_hotel_mart.stats import ReloadStats
+
+    if not isinstance(obj, (mmod.Offer, mmod.HotelOffer)):
+        return
+    alias = shards.shard_for(obj.hotel_id)
+    if alias not in collectors:
+        collectors[alias] = ReloadStats()
+    stats = collectors[alias]
+    if isinstance(obj, mmod.HotelOffer):
+        stats.hotel_offer(obj.hotel_id, obj.hour_id)
+        return
+    valid = ( datetime.datetime.combine(obj.valid_to_date, obj.valid_to_time)
+            - datetime.datetime.combine( obj.valid_from_date
+                                       , obj.valid_from_time ) )
+    days = (obj.checkout_date - obj.checkin_date).days
+    stats.offer(obj, int(valid.total_seconds() // 3600) + 1, days)
+
+def save_stats(results, mmod, using=None):
+    for name, data in results.items():
+        mmod.MartStat.objects.using(using).update_or_create(
+            name=name, defaults={ 'data' : json.dumps(data) })
+
+def reload_mart(argv=None):
+    '''
+    Scrutinise the parameters, and takes data from the warehouse.  Every reload
+    loads all offers into a new generation, next to the one the API reads, and
+    publishes it at the end (see Generation).  The generations superseded are
+    removed later by hqm-gc.  Truncating the tables (-t) empties the mart at
+    once instead, the API answers from nothing until the reload ends.
+
+    Progress is recorded after every chunk of warehouse offers, a reload that
+    crashed or was killed continues from there with --resume.  A chunk is also
+    a transaction, one commit for all rows it produces.  With -u the indexes of
+    the hour cache are dropped for the load and rebuilt when it ends, only in
+    a load from scratch (-t): the API needs them to read the published
+    generation.  Resuming such a load drops and rebuilds them again.
+
+    Statistics about the rows loaded are collected on the way and saved in
+    the MartStat table of each shard at the end.
+
+    The warehouse is read through a source (-s, see sources.py): the django
+    models by default, plain SQL when the warehouse is on the same database
+    server, or CSV files.
+    '''
+    usage = 'hqm-reload [-hvtru] [-c <offers per chunk>] [-s <source>]'
+    if argv is None:
+        argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hvt')
-    except getopt.GetopetError as e:
+        opts, args = getopt.getopt(argv, 'hvtruc:s:', [ 'resume' ])
+    except getopt.GetoptError as e:
         print(e)
         print(usage)
         sys.exit(2)
     truncate = False
     verbose = False
+    resume = False
+    unsafe = False
+    chunk = 1000
+    spec = None
     for o, a in opts:
         if '-h' == o:
             print(usage)
@@ -263,40 +713,126 @@ def reload_mart():
             truncate = True
         elif '-v' == o:
             verbose = True
+        elif o in ('-r', '--resume'):
+            resume = True
+        elif '-u' == o:
+            unsafe = True
+        elif '-c' == o:
+            if not re.search(r'^[1-9]\d*$', a):
+                print(usage)
+                sys.exit(1)
+            chunk = int(a)
+        elif '-s' == o:
+            if a.partition(':')[0] not in sources.SOURCES:
+                print(usage)
+                sys.exit(1)
+            spec = a
         else:
             assert False, 'unhandled option [%s]' % o
+    if truncate and resume:
+        print('ERROR: Cannot resume a reload into truncated tables.')
+        sys.exit(1)
+    if unsafe and not truncate and not resume:
+        # The API keeps reading the published generation during a reload, it
+        # would scan the whole hour cache without the indexes.
+        print('ERROR: Cannot drop the indexes (-u) without truncating (-t).')
+        sys.exit(1)
+
+    setup_django()
+    from django.conf import settings
+    from hq_hotel_mart import models as mmod
+
+    try:
+        source = sources.get_source(
+            spec or getattr(settings, 'HQ_MART_SOURCE', 'django'))
+    except ValueError as e:
+        print('ERROR: Cannot read the warehouse,', e)
+        sys.exit(1)
+    started = checkpoint_start(mmod, resume, unsafe)
+    if started is None:
+        print('ERROR: No unfinished reload to resume.')
+        sys.exit(1)
+    after, generation, dropping = started
+    if unsafe and not dropping:
+        print('ERROR: The reload to resume kept its indexes, cannot use -u.')
+        sys.exit(1)
+    unsafe = dropping
+    if after:
+        print( 'Resuming generation %i after warehouse offer %i'
+             % (generation, after) )
+    elif verbose:
+        print('Loading generation', generation)
+    last = [ after ]
+    def checkpoint(offer_id):
+        last[0] = offer_id
+        checkpoint_save(mmod, offer_id)
+        if verbose:
+            print('CHECKPOINT', offer_id)
 
     if truncate:
         # We cannot use direct SQL because we need the model to route itself to
         # the correct database instance.  Although this may be slow.
         print('WARNING: Truncating tables')
-        mmod.Currency.objects.all().delete()
-        mmod.Offer.objects.all().delete()
-        mmod.HotelOffer.objects.all().delete()
-    for p,obj in mart_load_tables(mmod, wmod, settings):
-        if obj and verbose:
-            print('SUCCESS', obj.__class__.__name__, obj)
-        elif not obj:
-            print('FAILURE', p)
-        # else stay silent
-
-def populate_hours():
+        for alias in shards.shard_aliases():
+            mmod.Currency.objects.using(alias).all().delete()
+            mmod.Offer.objects.using(alias).all().delete()
+            mmod.HotelOffer.objects.using(alias).all().delete()
+            mmod.HotelPresence.objects.using(alias).all().delete()
+    dropped = []
+    collectors = {}
+    try:
+        if unsafe:
+            print('WARNING: Dropping the hour cache indexes')
+            for alias in shards.shard_aliases():
+                hotel_offer_indexes(mmod, True, alias)
+                dropped.append(alias)
+        for p,obj in mart_load_tables( mmod, source, settings, generation
+                                     , after, chunk, checkpoint ):
+            if obj:
+                collect_stats(collectors, obj, mmod)
+            if obj and verbose:
+                print('SUCCESS', obj.__class__.__name__, obj)
+            elif not obj:
+                print('FAILURE', p)
+            # else stay silent
+    finally:
+        # Even when the load failed, the API is useless without them
+        for alias in dropped:
+            print( 'Rebuilding the hour cache indexes on'
+                 , shards.shard_db(alias, mmod.HotelOffer) )
+            hotel_offer_indexes(mmod, False, alias)
+    from hq_hotel_mart.stats import ReloadStats
+    fp_rate = getattr(settings, 'HQ_MART_PRESENCE_FP_RATE', 0.01)
+    for alias in shards.shard_aliases():
+        stats = collectors.get(alias) or ReloadStats()
+        built = sum(mart_build_presence( fp_rate, 1000, mmod, generation
+                                       , alias, stats.pairs ))
+        if verbose:
+            print('SUCCESS', built, 'presence filters on', alias or 'default')
+        results = stats.results()
+        # a resumed reload has seen only the offers after the checkpoint
+        results['reload'] = { 'resumedAfter' : after or None }
+        save_stats(results, mmod, alias)
+        if verbose:
+            print('SUCCESS', len(results), 'statistics on', alias or 'default')
+    # Until here the API kept reading the previous generation.  A reload killed
+    # before the checkpoint below is resumed into this same generation.
+    generation_publish(mmod, generation)
+    checkpoint_save(mmod, last[0], finished=True)
+    print('Published generation', generation)
+
+def populate_hours(argv=None):
     '''
     Builds the hours table for one entire year, several years can be populated
     at the same time in the mart.  It is also possible to truncate the table,
     this is useful when old offers do not make sense anymore to be in the mart.
     '''
-    settings_path()
-    import django
-    django.setup()
-    from django.conf import settings
-    from hq_warehouse import models as wmod
-    from hq_hotel_mart import models as mmod
-
     usage = 'hqm-pop-hours [-hvt] -y <4 digit year>'
+    if argv is None:
+        argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hvty:')
-    except getopt.GetopetError as e:
+        opts, args = getopt.getopt(argv, 'hvty:')
+    except getopt.GetoptError as e:
         print(e)
         print(usage)
         sys.exit(2)
@@ -322,18 +858,583 @@ def populate_hours():
     if not year:
         print(usage)
         sys.exit(1)
+
+    setup_django()
+    from django.conf import settings
+    from hq_hotel_mart import models as mmod
+    if truncate:
+        print('WARNING: Truncating tables')
+        for alias in shards.shard_aliases():
+            mmod.Hour.objects.using(alias).all().delete()
+    # the year is all we need, no warehouse models
+    for date_hour in mart_load_year(year, mmod, None, settings):
+        # every shard needs the full time frame
+        for alias in shards.shard_aliases():
+            hour = save_object( { 'day'  : date_hour.date()
+                                , 'hour' : date_hour.time().hour
+                                }
+                              , mmod.Hour
+                              , alias
+                              )
+            if hour and verbose:
+                print('SUCCESS', hour)
+            elif not hour:
+                print('FAILURE', date_hour.strftime('%Y-%m-%dT%H'))
+            # else stay silent
+
+def mart_is_empty(mmod, using=None):
+    from hq_hotel_mart import snapshot
+
+    return not any( getattr(mmod, name).objects.using(using).exists()
+                    for name in snapshot.SNAPSHOT_MODELS )
+
+def mart_import(path, truncate, mmod, using=None):
+    '''
+    Loads a snapshot file into the mart, truncating its tables first when
+    asked to.  All of it is a single transaction, the truncation included: a
+    broken snapshot leaves the mart as it was, not empty.  The truncation
+    forgets the reload checkpoint and statistics as well, they describe a mart
+    that is gone (a resumed reload would publish half a generation).
+
+    Yields the model and the number of rows of every chunk loaded.
+    '''
+    from hq_hotel_mart import snapshot
+
+    models = [ getattr(mmod, name) for name in snapshot.SNAPSHOT_MODELS ]
+    with transaction.atomic(using=shards.shard_db(using)):
+        if truncate:
+            # Children first, so the cascades have nothing left to do
+            for model in reversed(models):
+                model.objects.using(using).all().delete()
+            mmod.ReloadCheckpoint.objects.using(using).all().delete()
+            mmod.MartStat.objects.using(using).all().delete()
+        for chunk in snapshot.read_snapshot(path):
+            yield snapshot.load_chunk(chunk, mmod, using)
+        snapshot.reset_sequences(models, using)
+
+def export_mart(argv=None):
+    '''
+    Dumps a built mart into a snapshot file, the file can then be loaded into
+    other marts with hqm-import instead of reloading them from the warehouse.
+    Only the published generation is exported, as one consistent read.  A
+    sharded mart is exported one shard (database alias, -d) at a time.
+    '''
+    usage = ( 'hqm-export [-hv] [-c <rows per chunk>] [-d <database>] '
+            + '-f <snapshot file>' )
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hvc:d:f:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    verbose = False
+    chunk_size = 10000
+    using = None
+    path = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-v' == o:
+            verbose = True
+        elif '-c' == o:
+            if not re.search(r'^[1-9]\d*$', a):
+                print(usage)
+                sys.exit(1)
+            chunk_size = int(a)
+        elif '-d' == o:
+            using = a
+        elif '-f' == o:
+            path = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not path:
+        print(usage)
+        sys.exit(1)
+
+    setup_django()
+    from hq_hotel_mart import models as mmod
+    from hq_hotel_mart import snapshot
+    total = 0
+    try:
+        for table, rows in snapshot.write_snapshot( path, mmod, chunk_size
+                                                  , using ):
+            total += rows
+            if verbose:
+                print('SUCCESS', table, rows)
+    except ValueError as e:
+        print('ERROR: Nothing to export,', e)
+        sys.exit(1)
+    print('Exported %i rows to %s' % (total, path))
+
+def import_mart(argv=None):
+    '''
+    Loads a snapshot produced by hqm-export.  The rows keep their primary keys,
+    therefore the mart tables must be empty (or truncated with -t) first.
+    '''
+    usage = 'hqm-import [-hvt] [-d <database>] -f <snapshot file>'
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hvtd:f:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    truncate = False
+    verbose = False
+    using = None
+    path = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-t' == o:
+            truncate = True
+        elif '-v' == o:
+            verbose = True
+        elif '-d' == o:
+            using = a
+        elif '-f' == o:
+            path = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if not path:
+        print(usage)
+        sys.exit(1)
+
+    setup_django()
+    from django.db import DatabaseError
+    from hq_hotel_mart import models as mmod
+    if not truncate and not mart_is_empty(mmod, using):
+        print('ERROR: The mart is not empty, use -t to truncate it first.')
+        sys.exit(1)
     if truncate:
         print('WARNING: Truncating tables')
-        mmod.Hour.objects.all().delete()
-    for date_hour in mart_load_year(year, mmod, wmod, settings):
-        hour = save_object( { 'day'  : date_hour.date()
-                            , 'hour' : date_hour.time().hour
-                            }
-                          , mmod.Hour
-                          )
-        if hour and verbose:
-            print('SUCCESS', hour)
-        elif not hour:
-            print('FAILURE', date_hour.strftime('%Y-%m-%dT%H'))
-        # else stay silent
+    total = 0
+    try:
+        for model, rows in mart_import(path, truncate, mmod, using):
+            total += rows
+            if verbose:
+                print('SUCCESS', model.__name__, rows)
+    except (OSError, EOFError, KeyError, ValueError, DatabaseError) as e:
+        # a truncated gzip raises EOFError, a broken chunk KeyError and rows
+        # that do not fit the mart DatabaseError (IntegrityError)
+        print('FAILURE', e.__class__.__name__, e)
+        sys.exit(1)
+    print('Imported %i rows from %s' % (total, path))
+
+def warm_mart(argv=None):
+    '''
+    Warms up the mart databases after a deploy or a reload: reads the hour cache
+    of the upcoming hours through the API indexes, so the first API requests do
+    not pay for cold database buffers.  Optionally replays recorded API queries
+    (one query string or URL per line).
+
+    This warms the databases only, the caches of the API workers themselves are
+    warmed by hq_hotel_mart.warm.warm_worker() in each worker.
+    '''
+    usage = ( 'hqm-warm [-hv] [-n <query at>] [-a <hours ahead>] '
+            + '[-f <queries file>]' )
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hvn:a:f:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    verbose = False
+    start = datetime.datetime.now()
+    ahead = 24
+    path = None
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-v' == o:
+            verbose = True
+        elif '-n' == o:
+            try:
+                start = datetime.datetime.strptime(a, '%Y-%m-%dT%H')
+            except ValueError:
+                print(usage)
+                sys.exit(1)
+        elif '-a' == o:
+            if not re.search(r'^\d+$', a):
+                print(usage)
+                sys.exit(1)
+            ahead = int(a)
+        elif '-f' == o:
+            path = a
+        else:
+            assert False, 'unhandled option [%s]' % o
+
+    setup_django()
+    from hq_hotel_mart import warm
+    found = warm.warm_hours(start, ahead)
+    for alias, rows in warm.touch_hours(found).items():
+        print( 'Warmed %i hours (%i rows) on %s'
+             % (len(found[alias]), rows, alias or 'default') )
+    if not path:
+        return
+    with open(path) as f:
+        replayed = 0
+        for query, status in warm.replay_queries(f):
+            replayed += 1
+            if 200 != status:
+                print('FAILURE', status, query)
+            elif verbose:
+                print('SUCCESS', status, query)
+    print('Replayed %i queries' % replayed)
+
+def roll_mart(argv=None):
+    '''
+    Moves the time frame of the mart forward without a full reload: adds the
+    hours up to --ahead-days from now, with their hour cache built from the
+    offers already in the mart, and removes the hours older than --keep-days,
+    with their hour cache, in small batches.
+    '''
+    usage = ( 'hqm-roll [-hv] -k <keep days> -a <ahead days> '
+            + '[-n <now>] [-b <batch size>]' )
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt( argv, 'hvk:a:n:b:'
+                                  , [ 'keep-days=' , 'ahead-days=' ] )
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    verbose = False
+    keep = None
+    ahead = None
+    now = datetime.datetime.now()
+    batch = 1000
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-v' == o:
+            verbose = True
+        elif o in ('-k', '--keep-days', '-a', '--ahead-days', '-b'):
+            if not re.search(r'^\d+$', a):
+                print(usage)
+                sys.exit(1)
+            if o in ('-k', '--keep-days'):
+                keep = int(a)
+            elif o in ('-a', '--ahead-days'):
+                ahead = int(a)
+            else:
+                batch = max(1, int(a))
+        elif '-n' == o:
+            try:
+                now = datetime.datetime.strptime(a, '%Y-%m-%dT%H')
+            except ValueError:
+                print(usage)
+                sys.exit(1)
+        else:
+            assert False, 'unhandled option [%s]' % o
+    if keep is None or ahead is None:
+        print(usage)
+        sys.exit(1)
+
+    setup_django()
+    from hq_hotel_mart import models as mmod
+    now = now.replace(minute=0, second=0, microsecond=0)
+    df = now - datetime.timedelta(days=keep)
+    dt = now + datetime.timedelta(days=ahead, hours=1)
+    for alias in shards.shard_aliases():
+        name = alias or 'default'
+        added = {}
+        for model, rows in mart_add_hours(df, dt, batch, mmod, alias):
+            added[model.__name__] = added.get(model.__name__, 0) + rows
+            if verbose:
+                print('SUCCESS', name, 'added', rows, model.__name__)
+        removed = {}
+        for model, rows in mart_expire_hours(df, batch, mmod, alias):
+            removed[model.__name__] = removed.get(model.__name__, 0) + rows
+            if verbose:
+                print('SUCCESS', name, 'removed', rows, model.__name__)
+        print( 'Added %s and removed %s on %s'
+             % ( ', '.join('%i %s' % (n, m) for m,n in sorted(added.items()))
+                 or 'nothing'
+               , ', '.join('%i %s' % (n, m) for m,n in sorted(removed.items()))
+                 or 'nothing'
+               , name
+               ) )
+
+def gc_mart(argv=None):
+    '''
+    Removes the generations superseded by the last reload, in the background:
+    small batches, each its own transaction, with a pause after each.  The
+    generation the API read until the last publish is kept for a grace period
+    (-g seconds), workers may still have it cached.  Run it from cron, or after
+    every reload, it has nothing to do most of the time.
+    '''
+    usage = ( 'hqm-gc [-hv] [-b <batch size>] [-p <pause seconds>] '
+            + '[-g <grace seconds>]' )
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hvb:p:g:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    verbose = False
+    batch = 1000
+    pause = 0.1
+    grace = 60
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-v' == o:
+            verbose = True
+        elif o in ('-b', '-g'):
+            if not re.search(r'^\d+$', a):
+                print(usage)
+                sys.exit(1)
+            if '-b' == o:
+                batch = max(1, int(a))
+            else:
+                grace = int(a)
+        elif '-p' == o:
+            if not re.search(r'^\d+(\.\d*)?$', a):
+                print(usage)
+                sys.exit(1)
+            pause = float(a)
+        else:
+            assert False, 'unhandled option [%s]' % o
+
+    setup_django()
+    from django.utils.timezone import now
+    from hq_hotel_mart import models as mmod
+    before = now() - datetime.timedelta(seconds=grace)
+    for alias in shards.shard_aliases():
+        name = alias or 'default'
+        removed = {}
+        for model, rows in mart_collect_generations( before, batch, mmod
+                                                   , alias, pause ):
+            removed[model.__name__] = removed.get(model.__name__, 0) + rows
+            if verbose:
+                print('SUCCESS', name, 'removed', rows, model.__name__)
+        print( 'Removed %s on %s'
+             % ( ', '.join('%i %s' % (n, m) for m,n in sorted(removed.items()))
+                 or 'nothing'
+               , name
+               ) )
+
+def load_test(argv=None):
+    '''
+    Fires API queries at a running instance (-u) or straight at ApiView in this
+    process, and reports throughput and latency percentiles by outcome (exact,
+    fuzzy or mock answer).  Queries come from a file (-f, same format as for
+    hqm-warm) or are synthesized from the mart.  Django is only set up when
+    needed, a file against a URL needs no project at all.
+    '''
+    from hq_hotel_mart import loadtest
+
+    usage = ( 'hqm-loadtest [-h] [-u <api url>] [-f <queries file>] '
+            + '[-r <requests>] [-c <concurrency>] [-m <exact:fuzzy:mock>]' )
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hu:f:r:c:m:')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    url = None
+    path = None
+    requests = 1000
+    concurrency = 10
+    mix = [ 60 , 25 , 15 ]
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-u' == o:
+            url = a
+        elif '-f' == o:
+            path = a
+        elif o in ('-r', '-c'):
+            if not re.search(r'^[1-9]\d*$', a):
+                print(usage)
+                sys.exit(1)
+            if '-r' == o:
+                requests = int(a)
+            else:
+                concurrency = int(a)
+        elif '-m' == o:
+            if not re.search(r'^\d+:\d+:\d+$', a):
+                print(usage)
+                sys.exit(1)
+            mix = [ int(x) for x in a.split(':') ]
+        else:
+            assert False, 'unhandled option [%s]' % o
+
+    if not url or not path:
+        setup_django()
+    if path:
+        with open(path) as f:
+            queries = list(loadtest.read_queries(f))
+        # cycle through the file until we have enough requests
+        queries = [ queries[i % len(queries)]
+                    for i in range(requests) ] if queries else []
+    else:
+        from hq_hotel_mart import models as mmod
+        queries = loadtest.synthesize_queries( requests, mix, mmod
+                                             , shards.shard_aliases()
+                                             , random.Random() )
+    if not queries:
+        print('ERROR: No queries to run, is the mart loaded?')
+        sys.exit(1)
+    results, wall = loadtest.run(queries, concurrency, url)
+    for line in loadtest.report(results, wall):
+        print(line)
+
+# Tables reported by hqm-status, in the order they are loaded
+STATUS_MODELS = [ 'Currency'
+                , 'ExchangeRate'
+                , 'Hour'
+                , 'Offer'
+                , 'HotelOffer'
+                , 'HotelPresence'
+                ]
+
+def table_rows(model, using=None, exact=False):
+    '''
+    Number of rows in the table of the model, and whether it is exact.  On
+    postgres the planner estimate is used unless `exact` is asked for, since
+    counting the hour cache means reading all of it.
+    '''
+    from django.db import connections
+
+    conn = connections[shards.shard_db(using, model)]
+    if not exact and 'postgresql' == conn.vendor:
+        with conn.cursor() as cursor:
+            cursor.execute( 'SELECT reltuples FROM pg_class '
+                          + 'WHERE oid = %s::regclass'
+                          , [ model._meta.db_table ] )
+            row = cursor.fetchone()
+        # a table never analysed has no estimate
+        if row and row[0] >= 0:
+            return int(row[0]), False
+    return model.objects.using(using).count(), True
+
+def status_mart(argv=None):
+    '''
+    Prints the time frame loaded, the rows in each table of every shard and
+    the state of the last reload.  Meant to be called often (e.g. from cron or
+    a monitoring check), it only runs a handful of cheap queries per shard.
+    '''
+    usage = 'hqm-status [-hx]'
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'hx')
+    except getopt.GetoptError as e:
+        print(e)
+        print(usage)
+        sys.exit(2)
+    exact = False
+    for o, a in opts:
+        if '-h' == o:
+            print(usage)
+            sys.exit(0)
+        elif '-x' == o:
+            exact = True
+        else:
+            assert False, 'unhandled option [%s]' % o
+
+    setup_django()
+    from hq_hotel_mart import models as mmod
+    for alias in shards.shard_aliases():
+        hours = mmod.Hour.objects.using(alias).order_by('day', 'hour')
+        first = hours.first()
+        last = hours.last()
+        if first and last:
+            print( '%s: hours %sT%02i to %sT%02i'
+                 % (alias or 'default', first.day, first.hour
+                   , last.day, last.hour) )
+        else:
+            print('%s: no hours loaded' % (alias or 'default'))
+        generations = mmod.Generation.objects.using(alias).order_by('-number')
+        current = generations.filter(published__isnull=False).first()
+        if current:
+            print( '  generation %i published %s, %i in the mart'
+                 % ( current.number
+                   , current.published.strftime('%Y-%m-%d %H:%M')
+                   , generations.count() ) )
+        else:
+            print('  no generation published')
+        for name in STATUS_MODELS:
+            model = getattr(mmod, name)
+            rows, is_exact = table_rows(model, alias, exact)
+            print( '  %-16s %s%i'
+                 % (model._meta.verbose_name_plural, '' if is_exact else '~'
+                   , rows) )
+    using = shards.shard_aliases()[0]
+    qs = mmod.ReloadCheckpoint.objects.using(using).filter(name='offers')
+    checkpoint = qs.first()
+    if not checkpoint:
+        print('reload: none recorded')
+    else:
+        print( 'reload: %s generation %i at warehouse offer %i, started %s, '
+               'last saved %s'
+             % ( 'finished' if checkpoint.finished else 'unfinished'
+               , checkpoint.generation
+               , checkpoint.last_offer_id
+               , checkpoint.started.strftime('%Y-%m-%d %H:%M')
+               , checkpoint.updated.strftime('%Y-%m-%d %H:%M')
+               ) )
 
+
+# Subcommands of hqm: name, entry point and a line of help
+SUBCOMMANDS = [ ( 'reload'    , reload_mart
+                , 'load the offers from the warehouse' )
+              , ( 'pop-hours' , populate_hours
+                , 'populate the hours of a year' )
+              , ( 'roll'      , roll_mart
+                , 'move the time frame forward' )
+              , ( 'gc'        , gc_mart
+                , 'remove the generations superseded by reloads' )
+              , ( 'export'    , export_mart
+                , 'dump the mart into a snapshot file' )
+              , ( 'import'    , import_mart
+                , 'load a snapshot file into an empty mart' )
+              , ( 'warm'      , warm_mart
+                , 'warm up the database buffers' )
+              , ( 'loadtest'  , load_test
+                , 'fire API queries and report latencies' )
+              , ( 'status'    , status_mart
+                , 'row counts, time frame and last reload' )
+              ]
+
+def main(argv=None):
+    '''
+    The hqm command: `hqm <command> [<options>]` is the same as running
+    `hqm-<command> [<options>]`.  Nothing but the command run is imported or
+    set up, `hqm <command> -h` does not even touch django.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    usage = ( 'hqm [-h] <command> [<options>]\n\ncommands:\n'
+            + '\n'.join( '  %-10s %s' % (name, doc)
+                         for name, entry, doc in SUBCOMMANDS ) )
+    if not argv:
+        print(usage)
+        sys.exit(1)
+    if argv[0] in ('-h', '--help'):
+        print(usage)
+        sys.exit(0)
+    commands = dict((name, entry) for name, entry, doc in SUBCOMMANDS)
+    if argv[0] not in commands:
+        print('ERROR: Unknown command [%s]' % argv[0])
+        print(usage)
+        sys.exit(1)
+    commands[argv[0]](argv[1:])
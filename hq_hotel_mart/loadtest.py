@@ -0,0 +1,195 @@
+import asyncio, datetime, json, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+# Nothing here imports django at module level, a load test against a running
+# instance with a file of recorded queries needs no django project at all.
+
+
+OUTCOMES = [ 'exact' , 'fuzzy' , 'mock' , 'error' ]
+
+
+def read_queries(lines):
+    '''
+    Same format as hqm-warm: one query string or URL per line, empty lines and
+    lines starting with `#` are ignored.
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        yield line.split('?', 1)[-1]
+
+def synthesize_queries(count, mix, mmod, using_list, rnd):
+    '''
+    Builds `count` queries from the hour cache of the mart.  `mix` are the
+    weights of queries that should match exactly, match after a shift of the
+    check-in (fuzzy) and match nothing (mock).  Rows are sampled by random
+    primary key, ordering by random on the hour cache would scan all of it.
+    Only the generation the API reads is sampled, the rows of a reload in
+    progress or of superseded generations would not match as expected.
+    '''
+    from hq_hotel_mart.views import current_generation
+
+    kinds = rnd.choices(['exact', 'fuzzy', 'mock'], weights=mix, k=count)
+    bounds = {}
+    for using in using_list:
+        generation = current_generation(using)
+        if generation is None:
+            continue
+        qs = ( mmod.HotelOffer.objects.using(using)
+                   .filter(generation=generation)
+                   .order_by('pk') )
+        first = qs.values_list('pk', flat=True).first()
+        last = qs.values_list('pk', flat=True).last()
+        if first is not None:
+            bounds[using] = (qs, first, last)
+    if not bounds:
+        return []
+    queries = []
+    for kind in kinds:
+        using = rnd.choice(list(bounds))
+        qs, first, last = bounds[using]
+        ho = ( qs.filter(pk__gte=rnd.randint(first, last))
+                   .select_related('hour', 'offer_id')
+                   .first() )
+        query_at = datetime.datetime.combine( ho.hour.day
+                                            , datetime.time(ho.hour.hour) )
+        hotel_id = ho.hotel_id
+        cin = ho.offer_id.checkin_date
+        cout = ho.offer_id.checkout_date
+        if 'fuzzy' == kind:
+            shift = datetime.timedelta(days=rnd.choice([-3, -2, -1, 1, 2, 3]))
+            if cin + shift < query_at.date():
+                shift = -shift
+            cin += shift
+            cout += shift
+        elif 'mock' == kind:
+            # well above any hotel in the mart
+            hotel_id = 10 ** 9 + rnd.randint(0, 10 ** 6)
+        queries.append(
+            'queryAt=%s&hotelId=%i&checkinDate=%s&checkoutDate=%s'
+            % ( query_at.strftime('%Y-%m-%dT%H') , hotel_id
+              , cin.strftime('%Y-%m-%d') , cout.strftime('%Y-%m-%d') ) )
+    return queries
+
+def classify(query, status, body):
+    '''
+    Tells which path of ApiView answered.  A mock answer has no offer id, an
+    exact one has the requested dates, anything else was a fuzzy match.
+    '''
+    if 200 != status:
+        return 'error'
+    if body.startswith(b'//'):
+        body = body[2:]
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        return 'error'
+    if data.get('offerId') is None:
+        return 'mock'
+    args = parse_qs(query)
+    cin = (args.get('checkinDate') or [ None ])[0]
+    cout = (args.get('checkoutDate') or [ None ])[0]
+    if cin == data.get('checkinDate') and cout == data.get('checkoutDate'):
+        return 'exact'
+    return 'fuzzy'
+
+async def fetch(url, query):
+    '''
+    A bare HTTP/1.0 GET, one connection per request.  We only need the status
+    and a small body, not a full HTTP client.  HTTP/1.0 because servers may
+    answer an HTTP/1.1 request with a chunked body, which we would then have
+    to decode.
+    '''
+    parts = urlsplit(url)
+    secure = 'https' == parts.scheme
+    port = parts.port or (443 if secure else 80)
+    path = (parts.path or '/') + '?' + query
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection( parts.hostname, port
+                                                  , ssl=secure or None )
+    writer.write(( 'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n'
+                 % (path, parts.netloc) ).encode('ascii'))
+    data = await reader.read()
+    writer.close()
+    elapsed = time.perf_counter() - start
+    head, _, body = data.partition(b'\r\n\r\n')
+    try:
+        status = int(head.split(b' ', 2)[1])
+    except (IndexError, ValueError):
+        status = 0
+    return status, body, elapsed
+
+def call_view(query):
+    '''
+    Straight through ApiView in this process, no HTTP and no middleware.
+    '''
+    from django.test import RequestFactory
+    from hq_hotel_mart.views import ApiView
+
+    start = time.perf_counter()
+    response = ApiView.as_view()(RequestFactory().get('/api/?' + query))
+    elapsed = time.perf_counter() - start
+    return response.status_code, response.content, elapsed
+
+def run(queries, concurrency, url=None):
+    '''
+    Fires the queries with `concurrency` requests in flight and returns a list
+    of (outcome, latency) pairs, plus the wall clock time of the whole run.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    pending = iter(queries)
+    results = []
+
+    async def worker():
+        for query in pending:
+            try:
+                if url:
+                    status, body, elapsed = await fetch(url, query)
+                else:
+                    status, body, elapsed = await loop.run_in_executor(
+                        pool, call_view, query)
+            except OSError:
+                status, body, elapsed = 0, b'', 0.0
+            results.append((classify(query, status, body), elapsed))
+
+    start = time.perf_counter()
+    try:
+        loop.run_until_complete(asyncio.gather(
+            *[ worker() for i in range(concurrency) ]))
+    finally:
+        pool.shutdown()
+        loop.close()
+    return results, time.perf_counter() - start
+
+def percentile(values, pct):
+    # nearest rank, values must be sorted
+    if not values:
+        return 0.0
+    rank = max(0, int(round(pct / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+def report(results, wall):
+    '''
+    Throughput and latency percentiles (in milliseconds), overall and for each
+    outcome, as printable lines.
+    '''
+    lines = [ '%i requests in %.2fs, %.1f requests/s'
+              % (len(results), wall, len(results) / wall if wall else 0.0)
+            , '%-8s %8s %8s %8s %8s %8s'
+              % ('outcome', 'count', 'p50', 'p90', 'p99', 'max')
+            ]
+    groups = [ ('all', results) ]
+    groups += [ (o, [ r for r in results if o == r[0] ]) for o in OUTCOMES ]
+    for name, group in groups:
+        if not group:
+            continue
+        lat = sorted(elapsed * 1000 for outcome, elapsed in group)
+        lines.append( '%-8s %8i %8.2f %8.2f %8.2f %8.2f'
+                    % ( name, len(group)
+                      , percentile(lat, 50), percentile(lat, 90)
+                      , percentile(lat, 99), lat[-1] ) )
+    return lines
@@ -0,0 +1,74 @@
+import logging, re
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    # django < 1.10 only knows old style middleware, which is this
+    MiddlewareMixin = object
+
+
+logger = logging.getLogger(__name__)
+
+# Numbers and quoted strings, stripped to find queries of the same shape
+sql_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class QueryBudgetMiddleware(MiddlewareMixin):
+    '''
+    Counts the queries, and the time spent in them, of every request on all
+    databases (shards included).  Requests above the budget are logged as
+    warnings, together with queries repeated several times with different
+    arguments, which are most likely a template walking foreign keys (N+1).
+
+    Configured in the project settings:
+
+        HQ_MART_QUERY_BUDGET       maximum number of queries (default 10)
+        HQ_MART_QUERY_TIME_BUDGET  maximum SQL time in seconds (default 0.5)
+        HQ_MART_QUERY_REPEATS      repeats that make an N+1 (default 3)
+
+    Django records queries only in DEBUG mode, we force the recording for the
+    duration of the request.  It costs a little, enable the middleware where
+    you are hunting for slow views, not everywhere.
+    '''
+
+    def process_request(self, request):
+        marks = {}
+        for conn in connections.all():
+            marks[conn.alias] = (conn.force_debug_cursor, len(conn.queries_log))
+            conn.force_debug_cursor = True
+        request.hqm_query_marks = marks
+
+    def process_response(self, request, response):
+        marks = getattr(request, 'hqm_query_marks', None)
+        if marks is None:
+            # an earlier middleware answered before us
+            return response
+        queries = []
+        for conn in connections.all():
+            if conn.alias not in marks:
+                continue
+            forced, start = marks[conn.alias]
+            conn.force_debug_cursor = forced
+            queries += list(conn.queries_log)[start:]
+        self.check_budget(request, queries)
+        return response
+
+    def check_budget(self, request, queries):
+        budget = getattr(settings, 'HQ_MART_QUERY_BUDGET', 10)
+        time_budget = getattr(settings, 'HQ_MART_QUERY_TIME_BUDGET', 0.5)
+        repeats = getattr(settings, 'HQ_MART_QUERY_REPEATS', 3)
+        sql_time = sum(float(q['time']) for q in queries)
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else request.path
+        if len(queries) > budget or sql_time > time_budget:
+            logger.warning( '%s: %i queries in %.3fs (budget %i in %.3fs)'
+                          , view, len(queries), sql_time, budget, time_budget )
+        shapes = Counter(sql_literals.sub('?', q['sql']) for q in queries)
+        for sql, count in shapes.items():
+            if count >= repeats:
+                logger.warning( '%s: possible N+1, %i times: %s'
+                              , view, count, sql )
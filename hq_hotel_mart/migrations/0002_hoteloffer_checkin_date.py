@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def copy_checkin_date(apps, schema_editor):
+    '''
+    A single UPDATE, the hour cache is far too big to be walked row by row.
+    '''
+    HotelOffer = apps.get_model('hq_hotel_mart', 'HotelOffer')
+    Offer = apps.get_model('hq_hotel_mart', 'Offer')
+    qn = schema_editor.connection.ops.quote_name
+    sql = ( 'UPDATE {hoteloffer} SET {checkin} = '
+          + '(SELECT {offer}.{checkin} FROM {offer} '
+          + 'WHERE {offer}.{id} = {hoteloffer}.{offer_id})'
+          ).format( hoteloffer=qn(HotelOffer._meta.db_table)
+                  , offer=qn(Offer._meta.db_table)
+                  , checkin=qn('checkin_date')
+                  , id=qn('id')
+                  , offer_id=qn(HotelOffer._meta.get_field('offer_id').column)
+                  )
+    schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hoteloffer',
+            name='checkin_date',
+            field=models.DateField(help_text='date the guest must check-in', null=True, verbose_name='check-in date'),
+        ),
+        migrations.RunPython(copy_checkin_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='hoteloffer',
+            name='checkin_date',
+            field=models.DateField(help_text='date the guest must check-in', verbose_name='check-in date'),
+        ),
+        migrations.AlterIndexTogether(
+            name='hoteloffer',
+            index_together=set([('hour', 'hotel_id'), ('hour', 'hotel_id', 'days', 'checkin_date')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 18:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0002_hoteloffer_checkin_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HotelPresence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hotels', models.PositiveIntegerField(help_text='number of hotels in the filter', verbose_name='hotels')),
+                ('size', models.PositiveIntegerField(help_text='number of bits in the filter', verbose_name='size')),
+                ('hashes', models.PositiveSmallIntegerField(help_text='number of hash functions of the filter', verbose_name='hashes')),
+                ('bits', models.BinaryField(help_text='the filter itself', verbose_name='bits')),
+                ('hour', models.OneToOneField(help_text='hour the filter is for', on_delete=django.db.models.deletion.CASCADE, related_name='presence', to='hq_hotel_mart.Hour', verbose_name='hour')),
+            ],
+            options={
+                'verbose_name': 'hotel presence',
+                'verbose_name_plural': 'hotel presences',
+            },
+        ),
+    ]
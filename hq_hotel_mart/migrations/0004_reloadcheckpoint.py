@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0003_hotelpresence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReloadCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='what is being loaded', max_length=32, unique=True, verbose_name='name')),
+                ('last_offer_id', models.PositiveIntegerField(default=0, help_text='last warehouse offer id loaded', verbose_name='last offer id')),
+                ('finished', models.BooleanField(default=False, help_text='whether the reload ran to its end', verbose_name='finished')),
+                ('started', models.DateTimeField(auto_now_add=True, help_text='when the reload started', verbose_name='started')),
+                ('updated', models.DateTimeField(auto_now=True, help_text='when the last checkpoint was recorded', verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'reload checkpoint',
+                'verbose_name_plural': 'reload checkpoints',
+            },
+        ),
+    ]
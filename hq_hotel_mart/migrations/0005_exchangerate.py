@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 18:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0004_reloadcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('per_usd', models.DecimalField(decimal_places=10, help_text='units of the currency for one american dollar', max_digits=20, verbose_name='per usd')),
+                ('currency', models.OneToOneField(help_text='currency the rate converts to', on_delete=django.db.models.deletion.CASCADE, related_name='rate', to='hq_hotel_mart.Currency', verbose_name='currency')),
+            ],
+            options={
+                'verbose_name': 'exchange rate',
+                'verbose_name_plural': 'exchange rates',
+            },
+        ),
+    ]
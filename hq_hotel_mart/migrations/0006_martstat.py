@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 18:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0005_exchangerate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MartStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(help_text='what the statistic is about', max_length=32, unique=True, verbose_name='name')),
+                ('data', models.TextField(help_text='value of the statistic as JSON', verbose_name='data')),
+                ('updated', models.DateTimeField(auto_now=True, help_text='when the reload collected it', verbose_name='updated')),
+            ],
+            options={
+                'verbose_name': 'mart statistic',
+                'verbose_name_plural': 'mart statistics',
+            },
+        ),
+    ]
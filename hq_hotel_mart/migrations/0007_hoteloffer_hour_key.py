@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+
+
+def copy_hour_key(apps, schema_editor):
+    '''
+    One UPDATE per hour, each through the (hour, hotel_id) index.  Working the
+    key out in SQL would need date arithmetic that differs on every database.
+    '''
+    Hour = apps.get_model('hq_hotel_mart', 'Hour')
+    HotelOffer = apps.get_model('hq_hotel_mart', 'HotelOffer')
+    db = schema_editor.connection.alias
+    epoch = datetime.date(1970, 1, 1)
+    hours = Hour.objects.using(db).values_list('pk', 'day', 'hour')
+    for pk, day, hour in hours:
+        key = (day - epoch).days * 24 + hour
+        HotelOffer.objects.using(db).filter(hour_id=pk).update(hour_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0006_martstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hoteloffer',
+            name='hour_key',
+            field=models.PositiveIntegerField(help_text='hours since the epoch, the same hour as above', null=True, verbose_name='hour key'),
+        ),
+        migrations.RunPython(copy_hour_key, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='hoteloffer',
+            name='hour_key',
+            field=models.PositiveIntegerField(help_text='hours since the epoch, the same hour as above', verbose_name='hour key'),
+        ),
+        migrations.AlterIndexTogether(
+            name='hoteloffer',
+            index_together=set([('hour', 'hotel_id'), ('hour_key', 'hotel_id', 'days', 'checkin_date')]),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def publish_existing(apps, schema_editor):
+    '''
+    The rows already in the mart became generation 1, publish it so that the
+    API keeps reading them.  An unfinished reload resumes into it.
+    '''
+    Generation = apps.get_model('hq_hotel_mart', 'Generation')
+    Offer = apps.get_model('hq_hotel_mart', 'Offer')
+    ReloadCheckpoint = apps.get_model('hq_hotel_mart', 'ReloadCheckpoint')
+    db = schema_editor.connection.alias
+    if not Offer.objects.using(db).exists():
+        return
+    Generation.objects.using(db).create(
+        number=1, published=django.utils.timezone.now())
+    ReloadCheckpoint.objects.using(db).update(generation=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0007_hoteloffer_hour_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Generation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(help_text='generation number carried by the rows', unique=True, verbose_name='number')),
+                ('started', models.DateTimeField(auto_now_add=True, help_text='when the reload started loading it', verbose_name='started')),
+                ('published', models.DateTimeField(blank=True, help_text='when the reload finished and the API switched to it', null=True, verbose_name='published')),
+            ],
+            options={
+                'verbose_name': 'generation',
+                'verbose_name_plural': 'generations',
+            },
+        ),
+        migrations.AddField(
+            model_name='hoteloffer',
+            name='generation',
+            field=models.PositiveIntegerField(default=1, help_text='generation of the offer', verbose_name='generation'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='hotelpresence',
+            name='generation',
+            field=models.PositiveIntegerField(default=1, help_text='generation the filter was built from', verbose_name='generation'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='offer',
+            name='generation',
+            field=models.PositiveIntegerField(default=1, help_text='generation the offer was loaded in', verbose_name='generation'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='reloadcheckpoint',
+            name='generation',
+            field=models.PositiveIntegerField(default=0, help_text='generation being loaded', verbose_name='generation'),
+        ),
+        migrations.RunPython(publish_existing, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='hotelpresence',
+            name='hour',
+            field=models.ForeignKey(help_text='hour the filter is for', on_delete=django.db.models.deletion.CASCADE, related_name='presences', to='hq_hotel_mart.Hour', verbose_name='hour'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hotelpresence',
+            unique_together=set([('generation', 'hour')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='offer',
+            unique_together=set([('generation', 'hotel_id', 'breakfast_included', 'checkin_date', 'checkout_date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='hoteloffer',
+            index_together=set([('generation', 'hour_key', 'hotel_id', 'days', 'checkin_date'), ('generation', 'hour', 'hotel_id')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 19:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hq_hotel_mart', '0008_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reloadcheckpoint',
+            name='unsafe',
+            field=models.BooleanField(default=False, help_text='whether the reload dropped the hour cache indexes', verbose_name='unsafe'),
+        ),
+    ]
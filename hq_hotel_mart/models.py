@@ -7,6 +7,18 @@ import datetime
 from pytz import timezone
 
 
+# Hour keys count the hours since this day, at midnight
+HOUR_EPOCH = datetime.date(1970, 1, 1)
+
+def hour_key(day, hour):
+    '''
+    The hour of a day as a single integer, consecutive hours have consecutive
+    keys.  Days and hours are naive, as in the Hour table, so there are no
+    gaps or repeats when the clocks change.
+    '''
+    return (day - HOUR_EPOCH).days * 24 + hour
+
+
 class Currency(models.Model):
     '''
     The currency data in the mart can be assumed to be correct since it comes
@@ -37,11 +49,76 @@ class Currency(models.Model):
         verbose_name_plural = _('currencies')
 
 
+class ExchangeRate(models.Model):
+    '''
+    How many units of a currency one american dollar buys.  The warehouse has
+    no rates table, the rates are worked out from the offers at every reload
+    (original price against price in usd), see load_currency.
+    '''
+    currency = models.OneToOneField(
+          Currency
+        , verbose_name=_('currency')
+        , related_name='rate'
+        , help_text=_('currency the rate converts to')
+        )
+    per_usd = models.DecimalField(
+          _('per usd')
+        , max_digits=20
+        , decimal_places=10
+        , help_text=_('units of the currency for one american dollar')
+        )
+
+    def __str__(self):
+        return str(self.currency) + ' ' + str(self.per_usd)
+
+    class Meta:
+        verbose_name = _('exchange rate')
+        verbose_name_plural = _('exchange rates')
+
+
+class Generation(models.Model):
+    '''
+    A complete load of the offers and their hour cache.  A reload writes its
+    rows under a new generation number, next to the generation the API reads,
+    and publishes it once everything is loaded: the API only ever reads the
+    newest published generation, so it never sees a half loaded mart.  The
+    generations it superseded are removed by hqm-gc.
+    '''
+    number = models.PositiveIntegerField(
+          _('number')
+        , unique=True
+        , help_text=_('generation number carried by the rows')
+        )
+    started = models.DateTimeField(
+          _('started')
+        , auto_now_add=True
+        , help_text=_('when the reload started loading it')
+        )
+    published = models.DateTimeField(
+          _('published')
+        , null=True
+        , blank=True
+        , help_text=_('when the reload finished and the API switched to it')
+        )
+
+    def __str__(self):
+        return str(self.number)
+
+    class Meta:
+        verbose_name = _('generation')
+        verbose_name_plural = _('generations')
+
+
 class Offer(models.Model):
     '''
     The fields are the same as in the warehouse but the indexes are quite
     different.
     '''
+    # a plain number rather than a foreign key, it leads the indexes
+    generation = models.PositiveIntegerField(
+          _('generation')
+        , help_text=_('generation the offer was loaded in')
+        )
     hotel_id = models.PositiveIntegerField(
           _('hotel id')
         , help_text=_('the hotel providing the offer')
@@ -123,7 +200,8 @@ class Offer(models.Model):
             , ( 'hotel_id' , 'checkout_date' )
             , ( 'hotel_id' , 'checkin_date'  , 'checkout_date' )
             ]
-        unique_together = [ ( 'hotel_id'     , 'breakfast_included'
+        unique_together = [ ( 'generation'   , 'hotel_id'
+                            , 'breakfast_included'
                             , 'checkin_date' , 'checkout_date'      ) ]
         verbose_name = _('offer')
         verbose_name_plural = _('offers')
@@ -147,6 +225,10 @@ class Hour(models.Model):
     def __str__(self):
         return self.day.strftime('%Y-%m-%d') + 'T' + ('%02i' % self.hour)
 
+    @property
+    def key(self):
+        return hour_key(self.day, self.hour)
+
     def get_absolute_url(self):
         return reverse('hq_hotel_mart:hour', kwargs={ 'pk' : self.id })
 
@@ -168,12 +250,22 @@ class HotelOffer(models.Model):
 
     This table is pretty much a huge cache.
     '''
+    generation = models.PositiveIntegerField(
+          _('generation')
+        , help_text=_('generation of the offer')
+        )
     hour = models.ForeignKey(
           Hour
         , verbose_name=_('hour')
         , related_name='hotel_offers'
         , help_text=_('hour on which this offer is valid')
         )
+    # the same hour as an integer (see hour_key), the API computes it from the
+    # time of the query instead of looking the hour up
+    hour_key = models.PositiveIntegerField(
+          _('hour key')
+        , help_text=_('hours since the epoch, the same hour as above')
+        )
     # the hotel_id and days are here just for indexing
     hotel_id = models.PositiveIntegerField(
           _('hotel id')
@@ -185,6 +277,12 @@ class HotelOffer(models.Model):
           _('days')
         , help_text=_('number of days in the offer')
         )
+    # the check-in of the offer, so that the nearest dates can be found by
+    # walking the index instead of joining every offer of the hotel
+    checkin_date = models.DateField(
+          _('check-in date')
+        , help_text=_('date the guest must check-in')
+        )
     offer_id = models.ForeignKey(
           Offer
         , verbose_name=_('offer')
@@ -201,10 +299,142 @@ class HotelOffer(models.Model):
     class Meta:
         # this table is a huge cache for queries, index it properly
         unique_together = [ ( 'hour' , 'hotel_id' , 'offer_id' ) ]
+        # a reload inserts the rows of its generation into index pages of
+        # their own, away from the pages the API is reading
         index_together = [
-              ( 'hour' , 'hotel_id' )
-            , ( 'hour' , 'hotel_id' , 'days' )
+              ( 'generation' , 'hour' , 'hotel_id' )
+            , ( 'generation' , 'hour_key' , 'hotel_id' , 'days'
+              , 'checkin_date' )
             ]
         verbose_name = _('hotel offer')
         verbose_name_plural = _('hotel offers')
 
+
+class HotelPresence(models.Model):
+    '''
+    Bloom filter of the hotels that have at least one hotel offer in an hour,
+    built at the end of every reload.  The API checks it before querying the
+    hour cache: a hotel that is not in the filter has no offers in that hour,
+    and we can answer with the standard fare straight away.
+
+    An hour without a filter (e.g. added after the last reload) is unknown,
+    the API then queries the hour cache as usual.  Every generation has its
+    own filters.
+    '''
+    generation = models.PositiveIntegerField(
+          _('generation')
+        , help_text=_('generation the filter was built from')
+        )
+    hour = models.ForeignKey(
+          Hour
+        , verbose_name=_('hour')
+        , related_name='presences'
+        , help_text=_('hour the filter is for')
+        )
+    hotels = models.PositiveIntegerField(
+          _('hotels')
+        , help_text=_('number of hotels in the filter')
+        )
+    size = models.PositiveIntegerField(
+          _('size')
+        , help_text=_('number of bits in the filter')
+        )
+    hashes = models.PositiveSmallIntegerField(
+          _('hashes')
+        , help_text=_('number of hash functions of the filter')
+        )
+    bits = models.BinaryField(
+          _('bits')
+        , help_text=_('the filter itself')
+        )
+
+    def __str__(self):
+        return str(self.hour) + ' (' + str(self.hotels) + ' hotels)'
+
+    class Meta:
+        unique_together = [ ( 'generation' , 'hour' ) ]
+        verbose_name = _('hotel presence')
+        verbose_name_plural = _('hotel presences')
+
+
+class ReloadCheckpoint(models.Model):
+    '''
+    Progress of the last reload: the warehouse offers are loaded in id order,
+    every offer up to `last_offer_id` is already in the mart.  A reload that
+    died half way is resumed from here instead of from the first offer, into
+    the same generation.
+    '''
+    name = models.CharField(
+          _('name')
+        , max_length=32
+        , unique=True
+        , help_text=_('what is being loaded')
+        )
+    generation = models.PositiveIntegerField(
+          _('generation')
+        , default=0
+        , help_text=_('generation being loaded')
+        )
+    last_offer_id = models.PositiveIntegerField(
+          _('last offer id')
+        , default=0
+        , help_text=_('last warehouse offer id loaded')
+        )
+    finished = models.BooleanField(
+          _('finished')
+        , default=False
+        , help_text=_('whether the reload ran to its end')
+        )
+    unsafe = models.BooleanField(
+          _('unsafe')
+        , default=False
+        , help_text=_('whether the reload dropped the hour cache indexes')
+        )
+    started = models.DateTimeField(
+          _('started')
+        , auto_now_add=True
+        , help_text=_('when the reload started')
+        )
+    updated = models.DateTimeField(
+          _('updated')
+        , auto_now=True
+        , help_text=_('when the last checkpoint was recorded')
+        )
+
+    def __str__(self):
+        return self.name + ' @ ' + str(self.last_offer_id)
+
+    class Meta:
+        verbose_name = _('reload checkpoint')
+        verbose_name_plural = _('reload checkpoints')
+
+
+class MartStat(models.Model):
+    '''
+    Statistics about the data in a shard, collected by the last reload (see
+    stats.ReloadStats), one row per statistic with its value as JSON.  They
+    tell how the hour cache is spread over hours and hotels, for tuning
+    indexes, shards and cache sizes.
+    '''
+    name = models.CharField(
+          _('name')
+        , max_length=32
+        , unique=True
+        , help_text=_('what the statistic is about')
+        )
+    data = models.TextField(
+          _('data')
+        , help_text=_('value of the statistic as JSON')
+        )
+    updated = models.DateTimeField(
+          _('updated')
+        , auto_now=True
+        , help_text=_('when the reload collected it')
+        )
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = _('mart statistic')
+        verbose_name_plural = _('mart statistics')
@@ -0,0 +1,56 @@
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import router, transaction
+
+
+def shard_aliases():
+    '''
+    The database aliases (keys of settings.DATABASES) holding the mart.  When
+    HQ_MART_SHARDS is not configured the mart is not sharded and `None` is
+    used, i.e. let django (and its database routers) pick the database.
+
+    Currency and Hour are small and are replicated on every shard, Offer and
+    HotelOffer are split by hotel_id.
+    '''
+    shards = getattr(settings, 'HQ_MART_SHARDS', None)
+    if not shards:
+        return [ None ]
+    return list(shards)
+
+def shard_for(hotel_id):
+    '''
+    All offers of a hotel live in the same shard, so a query for a hotel never
+    needs to look at more than one database.  A plain modulo is enough as a
+    hash since hotel ids are sequential integers.
+
+    Note that changing the number of shards moves most hotels to a different
+    shard, the mart must then be reloaded from scratch (hqm-reload -t).
+    '''
+    shards = shard_aliases()
+    return shards[int(hotel_id) % len(shards)]
+
+def shard_db(using, model=None):
+    '''
+    The database alias behind a shard.  Querysets route `None` themselves,
+    but transactions and raw connections do not: transaction.atomic(None)
+    is the default database, whatever the routers say.  Resolve `None` to
+    the database the routers write `model` to (default the hour cache, all
+    mart tables live together).
+    '''
+    if using is not None:
+        return using
+    if model is None:
+        from hq_hotel_mart.models import HotelOffer as model
+    return router.db_for_write(model)
+
+def atomic_shards():
+    '''
+    A transaction open on every shard at once, use it as a context manager.
+    All of them commit when the block ends and all roll back on an exception,
+    although a crash between two commits may still commit only some shards.
+    '''
+    stack = ExitStack()
+    for alias in shard_aliases():
+        stack.enter_context(transaction.atomic(using=shard_db(alias)))
+    return stack
@@ -0,0 +1,169 @@
+import gzip, json
+
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+
+from . import shards
+
+
+# Bump this if the layout of the file changes, old snapshots will then be
+# refused on import instead of loading garbage.
+SNAPSHOT_FORMAT = 'hqm-snapshot'
+# 2 added HotelOffer.hour_key, 3 the generations
+SNAPSHOT_VERSION = 3
+
+# The order matters: foreign keys must point to rows already loaded.
+SNAPSHOT_MODELS = [ 'Generation'
+                  , 'Currency'
+                  , 'ExchangeRate'
+                  , 'Offer'
+                  , 'Hour'
+                  , 'HotelOffer'
+                  ]
+
+# Every chunk has them all
+SNAPSHOT_KEYS = set([ 'table' , 'columns' , 'data' ])
+
+
+def snapshot_columns(model):
+    '''
+    The database columns of the model, foreign keys are dumped as their raw
+    ids (e.g. `offer_id_id`) so we never need to follow them.
+    '''
+    return [ f.attname for f in model._meta.concrete_fields ]
+
+def write_snapshot(fp, mmod, chunk_size, using=None):
+    '''
+    Dumps the mart tables into a gzipped stream of JSON lines.  The first line
+    is a header, every following line is a chunk of at most `chunk_size` rows
+    of a single table stored by column, i.e.:
+
+        { "table"   : "Hour"
+        , "columns" : [ "id" , "day" , "hour" ]
+        , "data"    : [ [ 1 , 2 ] , [ "2016-01-01" , "2016-01-01" ] , [ 0 , 1 ] ]
+        }
+
+    Storing columns together compresses a lot better than storing rows, since
+    neighbouring values (hour ids, hotel ids, dates) are very much alike.
+
+    Only the generation the API reads is dumped, the others are a reload in
+    progress or leftovers for hqm-gc.  All tables are read in one repeatable
+    read transaction: a reload or hqm-gc running meanwhile cannot leave hour
+    cache rows in the file without their offers.  Raises ValueError when no
+    generation has been published.
+
+    Yields the table name and the number of rows of every chunk written.
+    '''
+    enc = DjangoJSONEncoder(separators=(',', ':'))
+    with transaction.atomic(using=shards.shard_db(using)):
+        repeatable_read(using)
+        generation = ( mmod.Generation.objects.using(using)
+                           .filter(published__isnull=False)
+                           .order_by('-number')
+                           .values_list('number', flat=True)
+                           .first() )
+        if generation is None:
+            raise ValueError('no generation published')
+        with gzip.open(fp, 'wt', encoding='utf-8') as gz:
+            header = { 'format'  : SNAPSHOT_FORMAT
+                     , 'version' : SNAPSHOT_VERSION }
+            gz.write(enc.encode(header) + '\n')
+            for name in SNAPSHOT_MODELS:
+                model = getattr(mmod, name)
+                columns = snapshot_columns(model)
+                qs = model.objects.using(using).order_by('pk')
+                if model is mmod.Generation:
+                    qs = qs.filter(number=generation)
+                elif 'generation' in columns:
+                    qs = qs.filter(generation=generation)
+                rows = qs.values_list(*columns).iterator()
+                for chunk in chunked(rows, chunk_size):
+                    data = [ list(col) for col in zip(*chunk) ]
+                    gz.write(enc.encode({ 'table'   : name
+                                        , 'columns' : columns
+                                        , 'data'    : data
+                                        }) + '\n')
+                    yield name, len(chunk)
+
+def repeatable_read(using=None):
+    '''
+    Makes the transaction just opened read a single snapshot of the database,
+    call it before its first query.  SQLite transactions always do.
+    '''
+    conn = connections[shards.shard_db(using)]
+    if conn.vendor in ('postgresql', 'mysql'):
+        with conn.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+def read_snapshot(fp):
+    '''
+    Reads back what `write_snapshot` produced, yields one chunk at a time so
+    that we never hold more than a chunk in memory.
+    '''
+    with gzip.open(fp, 'rt', encoding='utf-8') as gz:
+        header = json.loads(gz.readline() or '{}')
+        if ( SNAPSHOT_FORMAT != header.get('format')
+          or SNAPSHOT_VERSION != header.get('version') ):
+            raise ValueError('not a version %s hqm snapshot' % SNAPSHOT_VERSION)
+        for line in gz:
+            chunk = json.loads(line)
+            if not isinstance(chunk, dict) or not SNAPSHOT_KEYS <= set(chunk):
+                raise ValueError('broken chunk in snapshot')
+            if chunk['table'] not in SNAPSHOT_MODELS:
+                raise ValueError('unknown table [%s]' % chunk['table'])
+            yield chunk
+
+def load_chunk(chunk, mmod, using=None):
+    '''
+    Turns a columnar chunk back into model instances and inserts them in a
+    single bulk insert.  Primary keys are kept so that the foreign keys of the
+    following chunks still point to the right rows.
+    '''
+    model = getattr(mmod, chunk['table'])
+    # get_field() wants the field name, not the attname of foreign keys
+    by_attname = { f.attname : f for f in model._meta.concrete_fields }
+    fields = [ by_attname.get(c) for c in chunk['columns'] ]
+    if None in fields:
+        raise ValueError('snapshot columns do not match %s' % model.__name__)
+    objs = []
+    for row in zip(*chunk['data']):
+        params = { f.attname : f.to_python(v) for f,v in zip(fields, row) }
+        objs.append(model(**params))
+    model.objects.using(using).bulk_create(objs)
+    # bulk_create stamps auto_now(_add) fields with the time of the import,
+    # put the times of the snapshot back (only Generation has any, one row
+    # per reload)
+    stamped = [ f for f in fields
+                if getattr(f, 'auto_now', False)
+                or getattr(f, 'auto_now_add', False) ]
+    if stamped:
+        for row in zip(*chunk['data']):
+            params = dict( (f.attname, f.to_python(v))
+                           for f,v in zip(fields, row) )
+            pk = params[model._meta.pk.attname]
+            qs = model.objects.using(using).filter(pk=pk)
+            qs.update(**dict( (f.attname, params[f.attname])
+                              for f in stamped ))
+    return model, len(objs)
+
+def reset_sequences(models, using=None):
+    '''
+    We inserted explicit primary keys, databases with sequences (Postgres)
+    would otherwise hand out ids that are already taken on the next insert.
+    '''
+    conn = connections[shards.shard_db(using, models[0])]
+    sql = conn.ops.sequence_reset_sql(no_style(), models)
+    with conn.cursor() as cursor:
+        for stmt in sql:
+            cursor.execute(stmt)
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,297 @@
+import csv, glob, io, os
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_date, parse_time
+
+
+# A warehouse offer as the reload needs it, whatever the source.  The currency
+# is its code, the mart has its own currency ids.
+SourceOffer = namedtuple('SourceOffer', [ 'pk'
+                                        , 'hotel_id'
+                                        , 'price_usd'
+                                        , 'original_price'
+                                        , 'currency_code'
+                                        , 'breakfast_included'
+                                        , 'valid_from_date'
+                                        , 'valid_to_date'
+                                        , 'valid_from_time'
+                                        , 'valid_to_time'
+                                        , 'checkin_date'
+                                        , 'checkout_date'
+                                        ])
+
+SourceCurrency = namedtuple('SourceCurrency', [ 'code' , 'name' ])
+
+
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    # through str, a float from sqlite must not bring its binary noise along
+    return Decimal(str(value))
+
+def to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 't', 'true', 'y', 'yes')
+    return bool(value)
+
+def to_date(value):
+    return value if not isinstance(value, str) else parse_date(value)
+
+def to_time(value):
+    return value if not isinstance(value, str) else parse_time(value)
+
+def check_database(using):
+    if using and using not in connections.databases:
+        raise ValueError('no such database [%s]' % using)
+
+def parse_offer(row):
+    '''
+    A SourceOffer from a row in the order of its fields, with the values as
+    the database driver returns them or as text (CSV files, COPY output).
+    '''
+    ( pk, hotel_id, price_usd, original_price, code, breakfast
+    , from_date, to_date_, from_time, to_time_, checkin, checkout ) = row
+    return SourceOffer( int(pk)
+                      , int(hotel_id)
+                      , to_decimal(price_usd)
+                      , to_decimal(original_price)
+                      , code
+                      , to_bool(breakfast)
+                      , to_date(from_date)
+                      , to_date(to_date_)
+                      , to_time(from_time)
+                      , to_time(to_time_)
+                      , to_date(checkin)
+                      , to_date(checkout)
+                      )
+
+
+class Source(object):
+    '''
+    Where a reload reads the warehouse from.  A source lists the currencies
+    and walks the valid offers in id order, in chunks, starting after a given
+    id so that a reload can be resumed.
+
+    The exchange rates are worked out from the sums of the prices of the
+    offers of each currency.  By default that is a walk over all offers, the
+    sources that can group in the database do it there.
+    '''
+
+    def currencies(self):
+        raise NotImplementedError
+
+    def offer_chunks(self, after, chunk):
+        raise NotImplementedError
+
+    def rate_sums(self):
+        '''
+        The sum of the original prices and the sum of the prices in usd of
+        the offers of each currency, by currency code.
+        '''
+        sums = {}
+        for offers in self.offer_chunks(0, 10000):
+            for offer in offers:
+                if 0 >= offer.price_usd:
+                    continue
+                original, usd = sums.get(offer.currency_code, (0, 0))
+                sums[offer.currency_code] = ( original + offer.original_price
+                                            , usd + offer.price_usd )
+        return sums
+
+
+class DjangoSource(Source):
+    '''
+    The warehouse django models (hq_warehouse), read from the database the
+    project routes them to, or from `using`.  The rows come as tuples, one
+    query per chunk, no model instance is built.
+    '''
+
+    def __init__(self, using=None):
+        from hq_warehouse import models as wmod
+        check_database(using)
+        self.wmod = wmod
+        self.using = using
+
+    def currencies(self):
+        qs = self.wmod.Currency.objects.using(self.using).order_by('pk')
+        rows = qs.values_list('code', 'name')
+        return [ SourceCurrency(*row) for row in rows ]
+
+    def offer_chunks(self, after, chunk):
+        qs = ( self.wmod.ValidOffer.objects.using(self.using)
+                   .filter(invalid=False)
+                   .order_by('pk')
+                   .values_list( 'pk'
+                               , 'hotel_id'
+                               , 'price_usd'
+                               , 'original_price'
+                               , 'original_currency__code'
+                               , 'breakfast_included'
+                               , 'valid_from_date'
+                               , 'valid_to_date'
+                               , 'valid_from_time'
+                               , 'valid_to_time'
+                               , 'checkin_date'
+                               , 'checkout_date'
+                               ) )
+        while True:
+            # A fresh query per chunk, an open cursor would not survive the
+            # commits of the reload in between on every database.
+            rows = list(qs.filter(pk__gt=after)[:chunk])
+            if not rows:
+                return
+            yield [ SourceOffer(*row) for row in rows ]
+            after = rows[-1][0]
+
+    def rate_sums(self):
+        from django.db.models import Sum
+
+        qs = ( self.wmod.ValidOffer.objects.using(self.using)
+                   .filter(invalid=False, price_usd__gt=0)
+                   .order_by()
+                   .values_list('original_currency__code')
+                   .annotate(Sum('original_price'), Sum('price_usd')) )
+        return dict( (code, (to_decimal(original), to_decimal(usd)))
+                     for code, original, usd in qs )
+
+
+class SqlSource(Source):
+    '''
+    Plain SQL over the warehouse tables, for a warehouse on the same database
+    server as the mart: `using` is the alias of a connection that can read
+    the warehouse tables (default the default database).  No ORM at all, and
+    on postgres every chunk comes out of a single COPY, the cheapest way of
+    getting rows out of the server.
+
+    The table names are those django gives the hq_warehouse models, override
+    them in a subclass for a warehouse laid out differently.
+    '''
+    offer_table = 'hq_warehouse_validoffer'
+    currency_table = 'hq_warehouse_currency'
+
+    def __init__(self, using=None):
+        check_database(using)
+        self.connection = connections[using or DEFAULT_DB_ALIAS]
+
+    def offers_sql(self):
+        return ( 'SELECT o.id, o.hotel_id, o.price_usd, o.original_price'
+               + ', c.code, o.breakfast_included'
+               + ', o.valid_from_date, o.valid_to_date'
+               + ', o.valid_from_time, o.valid_to_time'
+               + ', o.checkin_date, o.checkout_date'
+               + ' FROM %s o JOIN %s c ON c.id = o.original_currency_id'
+               % (self.offer_table, self.currency_table)
+               + ' WHERE o.invalid = %s AND o.id > %s'
+               + ' ORDER BY o.id LIMIT %s' )
+
+    def currencies(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute( 'SELECT code, name FROM %s ORDER BY id'
+                          % self.currency_table )
+            return [ SourceCurrency(*row) for row in cursor.fetchall() ]
+
+    def offer_chunks(self, after, chunk):
+        while True:
+            if 'postgresql' == self.connection.vendor:
+                rows = self.copy_chunk(after, chunk)
+            else:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(self.offers_sql(), [ False, after, chunk ])
+                    rows = cursor.fetchall()
+            if not rows:
+                return
+            offers = [ parse_offer(row) for row in rows ]
+            yield offers
+            after = offers[-1].pk
+
+    def copy_chunk(self, after, chunk):
+        # COPY takes no parameters, they are all integers and booleans here
+        sql = self.offers_sql() % ('false', int(after), int(chunk))
+        buf = io.StringIO()
+        with self.connection.cursor() as cursor:
+            # the psycopg2 cursor under the django one
+            cursor.cursor.copy_expert( 'COPY (%s) TO STDOUT WITH CSV' % sql
+                                     , buf )
+        buf.seek(0)
+        return list(csv.reader(buf))
+
+    def rate_sums(self):
+        sql = ( 'SELECT c.code, SUM(o.original_price), SUM(o.price_usd)'
+              + ' FROM %s o JOIN %s c ON c.id = o.original_currency_id'
+              % (self.offer_table, self.currency_table)
+              + ' WHERE o.invalid = %s AND o.price_usd > 0 GROUP BY c.code' )
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, [ False ])
+            return dict( (code, (to_decimal(original), to_decimal(usd)))
+                         for code, original, usd in cursor.fetchall() )
+
+
+class FileSource(Source):
+    '''
+    A directory of CSV files: currencies.csv (code and name columns) and the
+    offers split into any number of offers*.csv files, read in the order of
+    their names.  The offer files have a header with the columns of the
+    warehouse ValidOffer, the currency by its code in original_currency and
+    the invalid column optional.  Ids must grow from one file to the next.
+
+    Enough to run, and time, a reload without a warehouse project.
+    '''
+    columns = [ 'id'
+              , 'hotel_id'
+              , 'price_usd'
+              , 'original_price'
+              , 'original_currency'
+              , 'breakfast_included'
+              , 'valid_from_date'
+              , 'valid_to_date'
+              , 'valid_from_time'
+              , 'valid_to_time'
+              , 'checkin_date'
+              , 'checkout_date'
+              ]
+
+    def __init__(self, path):
+        if not path or not os.path.isdir(path):
+            raise ValueError('no such directory [%s]' % path)
+        self.path = path
+
+    def currencies(self):
+        with open(os.path.join(self.path, 'currencies.csv')) as f:
+            return [ SourceCurrency(row['code'], row['name'])
+                     for row in csv.DictReader(f) ]
+
+    def offer_chunks(self, after, chunk):
+        offers = []
+        for name in sorted(glob.glob(os.path.join(self.path, 'offers*.csv'))):
+            with open(name) as f:
+                for row in csv.DictReader(f):
+                    if int(row['id']) <= after:
+                        continue
+                    if to_bool(row.get('invalid') or False):
+                        continue
+                    values = [ row[c] for c in self.columns ]
+                    offers.append(parse_offer(values))
+                    if len(offers) >= chunk:
+                        yield offers
+                        offers = []
+        if offers:
+            yield offers
+
+
+# Sources by the name given to hqm-reload -s
+SOURCES = { 'django' : DjangoSource
+          , 'sql'    : SqlSource
+          , 'csv'    : FileSource
+          }
+
+def get_source(spec):
+    '''
+    The source named by `spec`: `django[:<database>]`, `sql[:<database>]` or
+    `csv:<directory>`.  Raises ValueError when it cannot be used.
+    '''
+    name, sep, arg = spec.partition(':')
+    if name not in SOURCES:
+        raise ValueError('unknown source [%s]' % name)
+    return SOURCES[name](arg or None)
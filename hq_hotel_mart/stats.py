@@ -0,0 +1,144 @@
+import hashlib
+from array import array
+
+
+class CountMinSketch(object):
+    '''
+    Approximate counts of a stream of integers (hotel ids) in fixed memory.
+    An estimate is never below the true count, and above it by at most about
+    e / width of the total count with probability 1 - exp(-depth).
+
+    md5 again, as in BloomFilter, so that the estimates do not depend on the
+    process (hash() of ints is the int itself, a poor hash for a sketch).
+    '''
+
+    def __init__(self, width=2048, depth=4):
+        self.width = max(1, width)
+        self.depth = max(1, depth)
+        self.rows = [ array('L', [0]) * self.width for i in range(self.depth) ]
+
+    def positions(self, item):
+        digest = hashlib.md5(str(item).encode('ascii')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [ (h1 + i * h2) % self.width for i in range(self.depth) ]
+
+    def add(self, item, count=1):
+        for row, pos in zip(self.rows, self.positions(item)):
+            row[pos] += count
+
+    def estimate(self, item):
+        return min( row[pos]
+                    for row, pos in zip(self.rows, self.positions(item)) )
+
+
+class Histogram(object):
+    '''
+    Counts values in power of two buckets: [1, 2), [2, 4), [4, 8) and so on,
+    and everything below 1 in a single bucket.  Skewed distributions (rows per
+    hotel, prices) stay readable in a few dozen buckets, and two histograms
+    can be compared bucket by bucket.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+
+    def add(self, value, count=1):
+        bucket = int(value).bit_length() if value >= 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.low is None or value < self.low:
+            self.low = value
+        if self.high is None or value > self.high:
+            self.high = value
+
+    def to_dict(self):
+        buckets = []
+        for bucket, count in sorted(self.buckets.items()):
+            low = 2 ** (bucket - 1) if bucket else min(0, self.low)
+            buckets.append([ low , 2 ** bucket , count ])
+        return { 'count'   : self.count
+               , 'min'     : self.low
+               , 'max'     : self.high
+               , 'mean'    : self.total / self.count if self.count else None
+               , 'buckets' : buckets
+               }
+
+
+class ReloadStats(object):
+    '''
+    What a reload learns about one shard whilst loading it.  Fed with every
+    offer and hotel offer saved, in the order the reload saves them: all hotel
+    offers of an offer come one after the other, for the same hotel.
+
+    The rows of each hotel go into a count-min sketch, and the hotels with
+    the most rows are kept as heavy hitters.  A hotel is ranked once its run
+    of rows ends, not on every row.
+    '''
+
+    def __init__(self, top=20):
+        self.top = top
+        self.sketch = CountMinSketch()
+        self.heavy = {}
+        self.hours = {}
+        self.rows = 0
+        self.offers = 0
+        self.prices = Histogram()
+        self.validity = Histogram()
+        self.stays = Histogram()
+        self.pairs = Histogram()
+        self.last_hotel = None
+
+    def offer(self, offer, valid_hours, days):
+        self.offers += 1
+        self.prices.add(float(offer.price_usd))
+        self.validity.add(valid_hours)
+        self.stays.add(days)
+
+    def hotel_offer(self, hotel_id, hour_id):
+        self.rows += 1
+        self.hours[hour_id] = self.hours.get(hour_id, 0) + 1
+        self.sketch.add(hotel_id)
+        if hotel_id != self.last_hotel:
+            self.rank(self.last_hotel)
+            self.last_hotel = hotel_id
+
+    def rank(self, hotel_id):
+        if hotel_id is None:
+            return
+        estimate = self.sketch.estimate(hotel_id)
+        if hotel_id in self.heavy or len(self.heavy) < self.top:
+            self.heavy[hotel_id] = estimate
+            return
+        lightest = min(self.heavy, key=self.heavy.get)
+        if estimate > self.heavy[lightest]:
+            del self.heavy[lightest]
+            self.heavy[hotel_id] = estimate
+
+    def results(self):
+        '''
+        The statistics by name, as plain data ready to be dumped to JSON.
+        '''
+        self.rank(self.last_hotel)
+        per_hour = Histogram()
+        for rows in self.hours.values():
+            per_hour.add(rows)
+        heavy = sorted(self.heavy.items(), key=lambda h: -h[1])
+        return { 'totals'           : { 'offers'      : self.offers
+                                      , 'hotelOffers' : self.rows
+                                      , 'hours'       : len(self.hours)
+                                      }
+               , 'heavyHotels'      : [ { 'hotelId' : hotel_id
+                                        , 'rows'    : rows
+                                        } for hotel_id, rows in heavy ]
+               , 'rowsPerHour'      : per_hour.to_dict()
+               , 'rowsPerHotelHour' : self.pairs.to_dict()
+               , 'priceUsd'         : self.prices.to_dict()
+               , 'validityHours'    : self.validity.to_dict()
+               , 'stayDays'         : self.stays.to_dict()
+               }
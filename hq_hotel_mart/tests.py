@@ -1,2 +1,998 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.db.utils import ConnectionDoesNotExist
+from django.utils import timezone
 
+import asyncio, datetime, gzip, json, logging, os, random, shutil, tempfile
+from decimal import Decimal
+
+from . import command_line
+from . import loadtest
+from . import models
+from . import shards
+from . import snapshot
+from . import views
+from . import warm
+from .bloom import BloomFilter
+from .sources import FileSource, get_source
+from .stats import CountMinSketch, Histogram, ReloadStats
+
+
+MART_SETTINGS = { 'HQ_DW_DAY_PRICE'        : 100
+                , 'HQ_DW_DEFAULT_CURRECNY' : 'USD'
+                , 'HQ_MART_SHARDS'         : None
+                , 'HQ_MART_FUZZY_DAYS'     : 7
+                , 'HQ_MART_PRESENCE_TTL'   : 60
+                }
+
+
+@override_settings(**MART_SETTINGS)
+class MartTestCase(TestCase):
+    '''
+    A small mart: three days of hours, 20 hotels with three offers each, for
+    1, 2 and 3 nights from the next three days, all valid in every hour and
+    published as generation 1.
+    '''
+    day = datetime.date(2016, 1, 1)
+    hotels = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        usd = models.Currency.objects.create(code='USD', name='US Dollar')
+        eur = models.Currency.objects.create(code='EUR', name='Euro')
+        models.ExchangeRate.objects.create(currency=usd, per_usd=Decimal(1))
+        models.ExchangeRate.objects.create(currency=eur, per_usd=Decimal('0.5'))
+        models.Generation.objects.create(number=1, published=timezone.now())
+        hours = [ models.Hour(day=cls.day + datetime.timedelta(days=d), hour=h)
+                  for d in range(3) for h in range(24) ]
+        models.Hour.objects.bulk_create(hours)
+        hours = list(models.Hour.objects.order_by('day', 'hour'))
+        for hotel in range(cls.hotels):
+            for n in range(1, 4):
+                cin = cls.day + datetime.timedelta(days=n)
+                offer = models.Offer.objects.create(
+                      generation=1
+                    , hotel_id=hotel
+                    , price_usd=Decimal(100 + n)
+                    , original_price=Decimal(100 + n)
+                    , original_currency=usd
+                    , breakfast_included=False
+                    , valid_from_date=cls.day
+                    , valid_to_date=cls.day + datetime.timedelta(days=2)
+                    , valid_from_time=datetime.time(0)
+                    , valid_to_time=datetime.time(23)
+                    , checkin_date=cin
+                    , checkout_date=cin + datetime.timedelta(days=n)
+                    )
+                cls.cache_offer(offer, hours)
+
+    @classmethod
+    def cache_offer(cls, offer, hours):
+        days = (offer.checkout_date - offer.checkin_date).days
+        models.HotelOffer.objects.bulk_create([
+            models.HotelOffer( generation=offer.generation, hour=h
+                             , hour_key=h.key, hotel_id=offer.hotel_id
+                             , days=days, checkin_date=offer.checkin_date
+                             , offer_id=offer )
+            for h in hours ])
+
+    def copy_offer(self, hotel_id, checkin, **changes):
+        '''
+        Another offer like the one of the hotel for `checkin`, with `changes`,
+        cached in every hour.
+        '''
+        offer = models.Offer.objects.get( generation=1, hotel_id=hotel_id
+                                        , checkin_date=checkin )
+        offer.pk = None
+        for name, value in changes.items():
+            setattr(offer, name, value)
+        offer.save()
+        self.cache_offer(offer, models.Hour.objects.all())
+        return offer
+
+    def load_generation(self, number, price):
+        '''
+        A copy of the offers of hotel 7 in another generation, at `price`.
+        '''
+        models.Generation.objects.create(number=number)
+        hours = models.Hour.objects.all()
+        for offer in models.Offer.objects.filter(generation=1, hotel_id=7):
+            offer.pk = None
+            offer.generation = number
+            offer.price_usd = offer.original_price = Decimal(price)
+            offer.save()
+            self.cache_offer(offer, hours)
+
+    def setUp(self):
+        # count the hour and presence queries as well, as a cold worker would
+        views.HOURS.clear()
+        views.GENERATIONS.clear()
+        views.PRESENCE.clear()
+        views.RATES.clear()
+
+    def make_view(self, query_at, hotel_id, checkin, checkout):
+        view = views.ApiView()
+        view.query_at = datetime.datetime.strptime(query_at, '%Y-%m-%dT%H')
+        view.hotel_id = hotel_id
+        view.checkin = datetime.datetime.strptime(checkin, '%Y-%m-%d').date()
+        view.checkout = datetime.datetime.strptime(checkout, '%Y-%m-%d').date()
+        view.days = (view.checkout - view.checkin).days
+        view.currency = None
+        view.using = None
+        view.generation = 1
+        return view
+
+    def make_calendar(self, nights, first, last):
+        view = views.CalendarView()
+        view.query_at = datetime.datetime(2016, 1, 2, 10)
+        view.hotel_id = 7
+        view.days = nights
+        view.first = first
+        view.last = last
+        view.using = None
+        view.generation = 1
+        return view
+
+    def api(self, query, view=None):
+        view = (view or views.ApiView).as_view()
+        return view(RequestFactory().get('/api/?' + query))
+
+    def api_data(self, query, view=None):
+        response = self.api(query, view)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content.decode('utf-8').lstrip('/'))
+
+    def assertQueriesAtMost(self, num, query, view=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.api(query, view)
+        self.assertLessEqual( len(ctx.captured_queries), num
+                            , 'too many queries: %s' % ctx.captured_queries )
+        return response
+
+
+class QueryPlanTest(MartTestCase):
+    '''
+    Checks that the API queries still hit the indexes of the hour cache.  A
+    schema or ORM change that turns an index seek into a full table scan will
+    not break any result, only the response times, therefore we look at the
+    query plans.  Postgres would happily scan tiny test tables, sequential scans
+    are disabled whilst explaining so we see whether an index *can* be used.
+    The number of queries of each path of the API is checked as well.
+    '''
+
+    def explain(self, qs):
+        '''
+        Returns the plan lines of the queryset as the database produces them.
+        '''
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if 'sqlite' == connection.vendor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                # (id, parent, notused, detail)
+                return [ row[-1] for row in cursor.fetchall() ]
+            if 'postgresql' == connection.vendor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                return [ row[0] for row in cursor.fetchall() ]
+        self.skipTest('no plan checks for %s' % connection.vendor)
+
+    def assertUsesIndex(self, qs, table):
+        plan = self.explain(qs)
+        lines = [ l for l in plan if table in l ]
+        self.assertTrue(lines, 'no access to %s in plan: %s' % (table, plan))
+        for line in lines:
+            if 'sqlite' == connection.vendor:
+                # SQLite says SCAN for full table scans and SEARCH for seeks
+                self.assertIn('SEARCH', line, 'plan regressed: %s' % plan)
+            else:
+                self.assertNotIn('Seq Scan', line, 'plan regressed: %s' % plan)
+
+    def test_exact_query_uses_index(self):
+        view = self.make_view('2016-01-02T10', 7, '2016-01-03', '2016-01-05')
+        qs = view.exact_queryset()
+        self.assertUsesIndex(qs[:1], 'hq_hotel_mart_hoteloffer')
+        self.assertUsesIndex(qs[:1], 'hq_hotel_mart_offer')
+
+    def test_fuzzy_query_uses_index(self):
+        view = self.make_view('2016-01-02T10', 7, '2016-01-10', '2016-01-12')
+        for after in (True, False):
+            qs = view.fuzzy_queryset(after, datetime.timedelta(days=7))
+            self.assertUsesIndex(qs[:1], 'hq_hotel_mart_hoteloffer')
+            self.assertUsesIndex(qs[:1], 'hq_hotel_mart_offer')
+
+    def test_calendar_query_uses_index(self):
+        view = self.make_calendar( 2, datetime.date(2016, 1, 2)
+                                 , datetime.date(2016, 1, 31) )
+        qs = view.calendar_queryset()
+        self.assertUsesIndex(qs, 'hq_hotel_mart_hoteloffer')
+        self.assertUsesIndex(qs, 'hq_hotel_mart_offer')
+
+    def test_exact_match_query_count(self):
+        response = self.assertQueriesAtMost(4, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'"2016-01-05"', response.content)
+
+    def test_warm_exact_match_query_count(self):
+        warm.warm_hours(datetime.datetime(2016, 1, 2), 24)
+        response = self.assertQueriesAtMost(1, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05')
+        self.assertEqual(200, response.status_code)
+
+    def test_fuzzy_match_query_count(self):
+        response = self.assertQueriesAtMost(6, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-10&checkoutDate=2016-01-12')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'"2016-01-03"', response.content)
+
+    def test_mock_query_count(self):
+        response = self.assertQueriesAtMost(6, 'queryAt=2016-01-02T10'
+            + '&hotelId=999&checkinDate=2016-01-10&checkoutDate=2016-01-12')
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'"USD"', response.content)
+
+    def test_presence_skips_database(self):
+        list(command_line.mart_build_presence(0.01, 10, models, 1))
+        warm.warm_hours(datetime.datetime(2016, 1, 2), 24)
+        response = self.assertQueriesAtMost(0, 'queryAt=2016-01-02T10'
+            + '&hotelId=999&checkinDate=2016-01-10&checkoutDate=2016-01-12')
+        self.assertIn(b'"offerId":null', response.content.replace(b' ', b''))
+        response = self.assertQueriesAtMost(1, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05')
+        self.assertIn(b'"2016-01-05"', response.content)
+
+    def test_currency_query_count(self):
+        response = self.assertQueriesAtMost(5, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=eur')
+        self.assertEqual(200, response.status_code)
+
+    def test_warm_currency_query_count(self):
+        warm.warm_hours(datetime.datetime(2016, 1, 2), 24)
+        response = self.assertQueriesAtMost(1, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=EUR')
+        self.assertIn(b'"EUR"', response.content)
+
+    def test_unknown_currency_query_count(self):
+        response = self.assertQueriesAtMost(1, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=XYZ')
+        self.assertEqual(400, response.status_code)
+
+    def test_out_of_range_query_count(self):
+        response = self.assertQueriesAtMost(1, 'queryAt=2017-01-02T10'
+            + '&hotelId=7&checkinDate=2017-01-10&checkoutDate=2017-01-12')
+        self.assertEqual(404, response.status_code)
+
+    def test_calendar_query_count(self):
+        response = self.assertQueriesAtMost(4, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&nights=2&fromDate=2016-01-02&toDate=2016-01-06'
+            , views.CalendarView)
+        self.assertEqual(200, response.status_code)
+
+    def test_warm_calendar_query_count(self):
+        warm.warm_hours(datetime.datetime(2016, 1, 2), 24)
+        response = self.assertQueriesAtMost(1, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&nights=2&fromDate=2016-01-02&toDate=2016-02-01'
+            + '&currency=EUR', views.CalendarView)
+        self.assertIn(b'"51.00"', response.content)
+
+    def test_calendar_bad_range_query_count(self):
+        # refused before any query
+        response = self.assertQueriesAtMost(0, 'queryAt=2016-01-02T10'
+            + '&hotelId=7&nights=2&fromDate=2016-01-05&toDate=2016-01-03'
+            , views.CalendarView)
+        self.assertEqual(400, response.status_code)
+
+
+# The list template of hq_main, reduced to what walks the database
+LIST_TEMPLATE = ( '{% for o in object_list %}'
+                  '{{ o }} {{ o.original_currency.code }}\n'
+                  '{% endfor %}' )
+LIST_TEMPLATES = [ { 'BACKEND' : 'django.template.backends.django.'
+                                 'DjangoTemplates'
+                   , 'OPTIONS' : { 'loaders' :
+                                   [ ( 'django.template.loaders.locmem.Loader'
+                                     , { 'hq_main/list.html' : LIST_TEMPLATE }
+                                     ) ]
+                                 }
+                   } ]
+
+
+@override_settings( TEMPLATES=LIST_TEMPLATES
+                  , HQ_MART_QUERY_BUDGET=3
+                  , HQ_MART_QUERY_TIME_BUDGET=10
+                  , HQ_MART_QUERY_REPEATS=3 )
+class QueryBudgetTest(MartTestCase):
+    '''
+    Renders the offer list through QueryBudgetMiddleware, a page of offers
+    costs a count and a select, whatever the page size.
+    '''
+
+    def render(self, view):
+        from .middleware import QueryBudgetMiddleware
+        # through the hooks, as both middleware styles call them
+        middleware = QueryBudgetMiddleware()
+        request = RequestFactory().get('/offers/')
+        with CaptureQueriesContext(connection) as ctx:
+            middleware.process_request(request)
+            response = view.as_view()(request).render()
+            response = middleware.process_response(request, response)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(12, response.content.count(b'USD'))
+        return len(ctx.captured_queries)
+
+    def test_offer_list_within_budget(self):
+        logger = 'hq_hotel_mart.middleware'
+        with self.assertLogs(logger, 'DEBUG') as logs:
+            # assertLogs fails without any record, log one of our own
+            logging.getLogger(logger).debug('rendered')
+            queries = self.render(views.OfferListView)
+        self.assertLessEqual(queries, 2)
+        self.assertEqual(['rendered'], [r.getMessage() for r in logs.records])
+
+    def test_offer_list_n_plus_one(self):
+        class NPlusOneView(views.OfferListView):
+            queryset = models.Offer.objects.all()
+        with self.assertLogs('hq_hotel_mart.middleware', 'WARNING') as logs:
+            queries = self.render(NPlusOneView)
+        self.assertEqual(2 + 12, queries)
+        messages = [record.getMessage() for record in logs.records]
+        self.assertIn('/offers/: 14 queries', messages[0])
+        self.assertIn('possible N+1, 12 times', messages[1])
+        self.assertIn('hq_hotel_mart_currency', messages[1])
+
+
+class WarmTest(MartTestCase):
+
+    def test_touch_hours(self):
+        found = warm.warm_hours(datetime.datetime(2016, 1, 2), 23)
+        self.assertEqual(24, len(found[None]))
+        # counted in the database, a single query per shard
+        with CaptureQueriesContext(connection) as ctx:
+            touched = warm.touch_hours(found)
+        self.assertEqual({ None : self.hotels * 3 * 24 }, touched)
+        self.assertEqual(1, len(ctx.captured_queries))
+
+
+class HourKeyTest(MartTestCase):
+
+    def test_hour_keys(self):
+        # consecutive across midnight, and the same as stored by the reload
+        last = models.hour_key(datetime.date(2016, 1, 1), 23)
+        first = models.hour_key(datetime.date(2016, 1, 2), 0)
+        self.assertEqual(last + 1, first)
+        view = self.make_view('2016-01-02T10', 7, '2016-01-03', '2016-01-05')
+        hour = models.Hour.objects.get(day='2016-01-02', hour=10)
+        self.assertEqual(hour.key, view.hour_key())
+        self.assertEqual(hour.pk, view.get_hour())
+        view = self.make_view('2017-01-02T10', 7, '2017-01-03', '2017-01-05')
+        self.assertIsNone(view.get_hour())
+
+
+class FuzzyMatchTest(MartTestCase):
+
+    def test_fuzzy_match_nearest_date(self):
+        offer = self.copy_offer( 7, '2016-01-03', price_usd=Decimal(500)
+                               , checkin_date=datetime.date(2016, 1, 6)
+                               , checkout_date=datetime.date(2016, 1, 8) )
+        # 01-06 is a day after, the cheaper 01-03 is two days before
+        view = self.make_view('2016-01-02T10', 7, '2016-01-05', '2016-01-07')
+        match = view.nearest_match()
+        self.assertEqual(offer.pk, match.offer_id.pk)
+        # and 01-03, a day before 01-04, is nearer than 01-06, two days after
+        view = self.make_view('2016-01-02T10', 7, '2016-01-04', '2016-01-06')
+        match = view.nearest_match()
+        self.assertEqual(datetime.date(2016, 1, 3), match.checkin_date)
+
+    def test_fuzzy_match_equally_near(self):
+        offer = self.copy_offer( 7, '2016-01-03', price_usd=Decimal(50)
+                               , checkin_date=datetime.date(2016, 1, 7)
+                               , checkout_date=datetime.date(2016, 1, 9) )
+        # 01-03 and 01-07 are both two days from 01-05, the cheaper wins
+        view = self.make_view('2016-01-02T10', 7, '2016-01-05', '2016-01-07')
+        match = view.nearest_match()
+        self.assertEqual(offer.pk, match.offer_id.pk)
+        offer.price_usd = Decimal(500)
+        offer.save()
+        match = view.nearest_match()
+        self.assertEqual(datetime.date(2016, 1, 3), match.checkin_date)
+
+    def test_fuzzy_match_too_far(self):
+        view = self.make_view('2016-01-02T10', 7, '2016-01-20', '2016-01-22')
+        self.assertIsNone(view.nearest_match())
+
+    def test_fuzzy_match_end_of_time(self):
+        # the window after the requested date stops at date.max
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=9999-12-29&checkoutDate=9999-12-30')
+        self.assertIsNone(data['offerId'])
+        self.assertEqual('9999-12-29', data['checkinDate'])
+
+
+class CurrencyTest(MartTestCase):
+
+    def test_currency_conversion(self):
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=eur')
+        self.assertEqual('51.00', data['sellingPrice'])
+        self.assertEqual('EUR', data['currencyCode'])
+        # the standard price is converted as well
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=999&checkinDate=2016-01-10&checkoutDate=2016-01-12'
+            + '&currency=EUR')
+        self.assertEqual('100.00', data['sellingPrice'])
+
+    def test_same_currency_rounded(self):
+        models.Offer.objects.filter(hotel_id=7).update(
+            original_price=Decimal('288.8'))
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=usd')
+        self.assertEqual('288.80', data['sellingPrice'])
+        self.assertEqual('USD', data['currencyCode'])
+        # the standard price as well
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=999&checkinDate=2016-01-10&checkoutDate=2016-01-12'
+            + '&currency=USD')
+        self.assertEqual('200.00', data['sellingPrice'])
+
+    def test_unknown_currency(self):
+        response = self.api('queryAt=2016-01-02T10'
+            + '&hotelId=7&checkinDate=2016-01-03&checkoutDate=2016-01-05'
+            + '&currency=XYZ')
+        self.assertEqual(400, response.status_code)
+
+
+class CalendarTest(MartTestCase):
+
+    def test_calendar_cheapest_per_date(self):
+        offer = self.copy_offer( 7, '2016-01-03', breakfast_included=True
+                               , price_usd=Decimal(90)
+                               , original_price=Decimal(90) )
+        data = self.api_data('queryAt=2016-01-02T10'
+            + '&hotelId=7&nights=2&fromDate=2016-01-02&toDate=2016-01-06'
+            , views.CalendarView)
+        self.assertEqual(5, len(data['days']))
+        self.assertEqual( [ None , offer.pk , None , None , None ]
+                        , [ d['offerId'] for d in data['days'] ] )
+        self.assertEqual('2016-01-05', data['days'][1]['checkoutDate'])
+        self.assertEqual('200', str(data['days'][0]['sellingPrice']))
+
+    def test_calendar_bad_range(self):
+        for query in ( 'fromDate=2016-01-01&toDate=2016-01-05'
+                     , 'fromDate=2016-01-05&toDate=2016-01-03'
+                     , 'fromDate=2016-01-02&toDate=2016-04-01'
+                     , 'fromDate=9999-12-30&toDate=9999-12-31' ):
+            response = self.api('queryAt=2016-01-02T10'
+                + '&hotelId=7&nights=2&' + query, views.CalendarView)
+            self.assertEqual(400, response.status_code)
+
+    def test_calendar_too_many_nights(self):
+        for nights in ('31', '999999999'):
+            response = self.api('queryAt=2016-01-02T10&hotelId=7&nights='
+                + nights + '&fromDate=2016-01-03&toDate=2016-01-05'
+                , views.CalendarView)
+            self.assertEqual(400, response.status_code)
+
+
+class GenerationTest(MartTestCase):
+
+    def test_unpublished_generation_invisible(self):
+        query = ( 'queryAt=2016-01-02T10&hotelId=7'
+                + '&checkinDate=2016-01-03&checkoutDate=2016-01-05' )
+        self.load_generation(2, 80)
+        self.assertEqual( Decimal(102)
+                        , Decimal(self.api_data(query)['sellingPrice']) )
+        command_line.generation_publish(models, 2)
+        views.GENERATIONS.clear()
+        self.assertEqual( Decimal(80)
+                        , Decimal(self.api_data(query)['sellingPrice']) )
+
+    def test_collect_generations(self):
+        self.load_generation(2, 80)
+        self.load_generation(3, 70)
+        command_line.generation_publish(models, 2)
+        published = models.Generation.objects.get(number=2).published
+        # generation 2 is too fresh, workers may still read generation 1
+        before = published - datetime.timedelta(seconds=1)
+        self.assertFalse(list(command_line.mart_collect_generations(
+            before, 10, models)))
+        before = published + datetime.timedelta(seconds=1)
+        removed = {}
+        for model, rows in command_line.mart_collect_generations( before, 100
+                                                                , models ):
+            removed[model] = removed.get(model, 0) + rows
+        self.assertEqual(self.hotels * 3, removed[models.Offer])
+        self.assertEqual(1, removed[models.Generation])
+        self.assertEqual( [ 2 , 3 ]
+                        , sorted(set(models.HotelOffer.objects.values_list(
+                            'generation', flat=True))) )
+
+
+class RollTest(MartTestCase):
+
+    def test_add_hours_builds_cache(self):
+        offer = self.copy_offer( 7, '2016-01-03'
+                               , checkin_date=datetime.date(2016, 1, 4)
+                               , checkout_date=datetime.date(2016, 1, 6)
+                               , valid_to_date=datetime.date(2016, 1, 4)
+                               , valid_to_time=datetime.time(5) )
+        df = datetime.datetime(2016, 1, 2)
+        dt = datetime.datetime(2016, 1, 5)
+        added = {}
+        for model, rows in command_line.mart_add_hours(df, dt, 10, models):
+            added[model] = added.get(model, 0) + rows
+        # only that offer is still valid on 01-04, until 05:00
+        self.assertEqual({ models.Hour : 24 , models.HotelOffer : 6 }, added)
+        cache = models.HotelOffer.objects.filter(hour__day='2016-01-04')
+        self.assertEqual( [ (h, 7, 2, 1) for h in range(6) ]
+                        , list(cache.order_by('hour__hour').values_list(
+                            'hour__hour', 'hotel_id', 'days', 'generation')) )
+        self.assertTrue(all( ho.hour_key == ho.hour.key
+                             for ho in cache.select_related('hour') ))
+        self.assertEqual(set([ offer.pk ]), set(cache.values_list(
+            'offer_id', flat=True)))
+        data = self.api_data('queryAt=2016-01-04T03'
+            + '&hotelId=7&checkinDate=2016-01-04&checkoutDate=2016-01-06')
+        self.assertEqual(offer.pk, data['offerId'])
+        # nothing left to add
+        self.assertFalse(list(command_line.mart_add_hours(df, dt, 10, models)))
+
+    def test_expire_hours(self):
+        # an offer valid on the first day only, cached in its hours
+        old = models.Offer.objects.get(hotel_id=3, checkin_date='2016-01-02')
+        old.pk = None
+        old.breakfast_included = True
+        old.valid_to_date = datetime.date(2016, 1, 1)
+        old.save()
+        self.cache_offer(old, models.Hour.objects.filter(day='2016-01-01'))
+        df = datetime.datetime(2016, 1, 2, 6)
+        removed = {}
+        for model, rows in command_line.mart_expire_hours(df, 100, models):
+            removed[model] = removed.get(model, 0) + rows
+        self.assertEqual( { models.HotelOffer : self.hotels * 3 * 30 + 24
+                          , models.Hour       : 30
+                          , models.Offer      : 1 }
+                        , removed )
+        first = models.Hour.objects.order_by('day', 'hour').first()
+        self.assertEqual((datetime.date(2016, 1, 2), 6), (first.day, first.hour))
+        self.assertFalse(models.Offer.objects.filter(pk=old.pk).exists())
+        self.assertFalse(models.HotelOffer.objects.filter(
+            hour_key__lt=models.hour_key(df.date(), df.hour)).exists())
+        self.assertEqual(self.hotels * 3, models.Offer.objects.count())
+
+
+class LoadTestTest(MartTestCase):
+
+    def test_queries_from_published_generation(self):
+        # a reload in progress, for hotels the API does not know yet
+        models.Generation.objects.create(number=2)
+        hours = models.Hour.objects.all()
+        for hotel in range(500, 510):
+            offer = models.Offer.objects.get(hotel_id=7, checkin_date=self.day
+                                             + datetime.timedelta(days=2))
+            offer.pk = None
+            offer.hotel_id = hotel
+            offer.generation = 2
+            offer.save()
+            self.cache_offer(offer, hours)
+        queries = loadtest.synthesize_queries( 200, [ 1 , 0 , 0 ], models
+                                             , [ None ], random.Random(1) )
+        self.assertEqual(200, len(queries))
+        self.assertFalse([ q for q in queries if '&hotelId=50' in q ])
+        # the fixture has offers valid after their check-in, those are 400
+        outcomes = set()
+        for query in queries[:40]:
+            response = self.api(query)
+            if 200 == response.status_code:
+                outcomes.add(loadtest.classify( query, response.status_code
+                                              , response.content ))
+        self.assertEqual(set([ 'exact' ]), outcomes)
+
+    def test_fetch_plain_http(self):
+        requests = []
+
+        async def serve(reader, writer):
+            requests.append(await reader.readline())
+            writer.write(b'HTTP/1.0 200 OK\r\n\r\n//{"offerId":null}\n')
+            await writer.drain()
+            writer.close()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        server = loop.run_until_complete(
+            asyncio.start_server(serve, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        status, body, elapsed = loop.run_until_complete(loadtest.fetch(
+            'http://127.0.0.1:%i/api/' % port, 'hotelId=7'))
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        # an HTTP/1.1 request may be answered with a chunked body
+        self.assertEqual([ b'GET /api/?hotelId=7 HTTP/1.0\r\n' ], requests)
+        self.assertEqual('mock', loadtest.classify('hotelId=7', status, body))
+
+
+class SnapshotTest(MartTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def export(self, name='mart.hqm.gz', chunk_size=50):
+        path = os.path.join(self.path, name)
+        list(snapshot.write_snapshot(path, models, chunk_size))
+        return path
+
+    def rows(self):
+        return dict( (name, list(getattr(models, name).objects.order_by('pk')
+                                     .values_list()))
+                     for name in snapshot.SNAPSHOT_MODELS )
+
+    def test_round_trip(self):
+        # JSON keeps times to the millisecond
+        stamp = timezone.now().replace(microsecond=0)
+        models.Generation.objects.update(started=stamp, published=stamp)
+        before = self.rows()
+        path = self.export()
+        models.Offer.objects.filter(hotel_id=7).delete()
+        models.Currency.objects.filter(code='EUR').update(name='Euro area')
+        loaded = list(command_line.mart_import(path, True, models))
+        self.assertEqual( sum(len(r) for r in before.values())
+                        , sum(rows for model, rows in loaded) )
+        self.assertEqual(before, self.rows())
+        # keys were kept, and a second import needs the tables truncated
+        self.assertFalse(command_line.mart_is_empty(models))
+
+    def test_export_published_generation(self):
+        self.load_generation(2, 80)
+        path = self.export()
+        self.assertEqual(self.hotels * 3 + 3, models.Offer.objects.count())
+        list(command_line.mart_import(path, True, models))
+        self.assertEqual( [ 1 ] , list(models.Generation.objects
+                                       .values_list('number', flat=True)) )
+        self.assertEqual(self.hotels * 3, models.Offer.objects.count())
+        self.assertFalse(models.HotelOffer.objects.exclude(generation=1))
+
+    def test_import_forgets_reload(self):
+        path = self.export()
+        models.ReloadCheckpoint.objects.create( name='offers', generation=2
+                                              , last_offer_id=30 )
+        models.MartStat.objects.create(name='hours', data='{}')
+        list(command_line.mart_import(path, True, models))
+        self.assertFalse(models.ReloadCheckpoint.objects.exists())
+        self.assertFalse(models.MartStat.objects.exists())
+        # nothing left for hqm-reload --resume to continue
+        self.assertIsNone(command_line.checkpoint_start(models, True))
+
+    def test_export_nothing_published(self):
+        models.Generation.objects.update(published=None)
+        with self.assertRaises(ValueError):
+            self.export()
+
+    def test_broken_snapshot_keeps_mart(self):
+        before = self.rows()
+        path = self.export()
+        with open(path, 'rb') as f:
+            data = f.read()
+        half = os.path.join(self.path, 'half.hqm.gz')
+        with open(half, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        with self.assertRaises(EOFError):
+            list(command_line.mart_import(half, True, models))
+        # truncated in the same transaction, rolled back with it
+        self.assertEqual(before, self.rows())
+
+    def test_broken_chunk(self):
+        path = os.path.join(self.path, 'broken.hqm.gz')
+        with gzip.open(path, 'wt') as gz:
+            gz.write(json.dumps({ 'format'  : snapshot.SNAPSHOT_FORMAT
+                                , 'version' : snapshot.SNAPSHOT_VERSION }))
+            gz.write('\n' + json.dumps({ 'columns' : [] , 'data' : [] }))
+        with self.assertRaises(ValueError):
+            list(command_line.mart_import(path, True, models))
+        self.assertEqual(self.hotels * 3, models.Offer.objects.count())
+
+
+@override_settings(**MART_SETTINGS)
+class ReloadTest(TestCase):
+    '''
+    The reload as hqm-reload drives it, checkpoints included, from a directory
+    of CSV files.
+    '''
+    offers = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        day = datetime.date(2016, 1, 1)
+        models.Hour.objects.bulk_create([
+            models.Hour(day=day + datetime.timedelta(days=d), hour=h)
+            for d in range(3) for h in range(24) ])
+
+    def setUp(self):
+        # the caches of the reload would keep rows of the previous test
+        command_line.HOURS.clear()
+        command_line.CURRENCIES.clear()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        with open(os.path.join(self.path, 'currencies.csv'), 'w') as f:
+            f.write('code,name\nUSD,Dollar\n')
+        with open(os.path.join(self.path, 'offers.csv'), 'w') as f:
+            f.write(FileSourceTest.header)
+            for pk in range(1, self.offers + 1):
+                # a hotel each, valid for 48 hours
+                f.write( '%i,%i,100,100,USD,f,2016-01-01,2016-01-02'
+                         ',00:00:00,23:00:00,2016-01-03,2016-01-05,f\n'
+                       % (pk, pk) )
+        self.source = FileSource(self.path)
+
+    def load(self, generation, after=0, chunk=2, checkpoint=None):
+        '''
+        Loads as hqm-reload does, returns what failed to load.
+        '''
+        from django.conf import settings
+
+        return [ p for p,obj in command_line.mart_load_tables(
+                                    models, self.source, settings, generation
+                                  , after, chunk, checkpoint )
+                   if not obj ]
+
+    def loaded(self):
+        return ( sorted(models.Offer.objects.values_list('hotel_id', flat=True))
+               , models.HotelOffer.objects.count() )
+
+    def test_checkpoint_per_chunk(self):
+        checkpoints = []
+        def checkpoint(offer_id):
+            # within the transaction of the chunk, its rows all there
+            self.assertTrue(connection.in_atomic_block)
+            self.assertEqual(offer_id, models.Offer.objects.count())
+            checkpoints.append(offer_id)
+        self.assertEqual([], self.load(1, checkpoint=checkpoint))
+        self.assertEqual([ 2 , 4 , 5 ], checkpoints)
+        self.assertEqual(([ 1 , 2 , 3 , 4 , 5 ], 5 * 48), self.loaded())
+
+    def test_missing_hour(self):
+        # expired by hqm-roll whilst the reload was running
+        models.Hour.objects.filter(day=datetime.date(2016, 1, 1), hour=12
+                                  ).delete()
+        self.assertEqual([ None ] * 5, self.load(1))
+        self.assertEqual(([ 1 , 2 , 3 , 4 , 5 ], 5 * 47), self.loaded())
+
+    def test_chunk_is_a_transaction(self):
+        def checkpoint(offer_id):
+            if offer_id > 2:
+                raise RuntimeError('killed')
+        with self.assertRaises(RuntimeError):
+            self.load(1, checkpoint=checkpoint)
+        # the second chunk rolled back whole, the first one stays
+        self.assertEqual(([ 1 , 2 ], 2 * 48), self.loaded())
+
+    def test_resume_after_partly_loaded_chunk(self):
+        from django.conf import settings
+
+        after, generation, unsafe = command_line.checkpoint_start(
+            models, False)
+        def checkpoint(offer_id):
+            command_line.checkpoint_save(models, offer_id)
+        # killed in the second chunk, once offer 3 was loaded
+        loading = command_line.mart_load_tables(
+            models, self.source, settings, generation, after, 2, checkpoint)
+        for p,obj in loading:
+            if isinstance(obj, models.Offer) and 3 == obj.hotel_id:
+                break
+        loading.close()
+        self.assertEqual([ 1 , 2 ], self.loaded()[0])
+        # offer 3 committed nonetheless, as a crash between the commits of
+        # two shards leaves it, without a checkpoint
+        def stop(offer_id):
+            if offer_id > 3:
+                raise RuntimeError('killed')
+        with self.assertRaises(RuntimeError):
+            self.load(generation, 2, 1, stop)
+        self.assertEqual([ 1 , 2 , 3 ], self.loaded()[0])
+        after, resumed, unsafe = command_line.checkpoint_start(models, True)
+        self.assertEqual((2, generation), (after, resumed))
+        # the rows already there are found, not loaded twice
+        self.assertEqual([], self.load(generation, after, 2, checkpoint))
+        self.assertEqual(([ 1 , 2 , 3 , 4 , 5 ], 5 * 48), self.loaded())
+        self.assertEqual(5, models.ReloadCheckpoint.objects.get().last_offer_id)
+        command_line.checkpoint_save(models, 5, finished=True)
+        # nothing left to resume
+        self.assertIsNone(command_line.checkpoint_start(models, True))
+
+    def test_resume_inherits_unsafe(self):
+        self.assertIsNone(command_line.checkpoint_start(models, True))
+        after, generation, unsafe = command_line.checkpoint_start(
+            models, False, True)
+        self.assertEqual((0, True), (after, unsafe))
+        command_line.checkpoint_save(models, 42)
+        # resumed without -u, the indexes are still to be rebuilt
+        self.assertEqual( (42, generation, True)
+                        , command_line.checkpoint_start(models, True) )
+        command_line.checkpoint_save(models, 50, finished=True)
+        self.assertIsNone(command_line.checkpoint_start(models, True))
+        # a new reload starts a new generation, with its indexes
+        self.assertEqual( (0, generation + 1, False)
+                        , command_line.checkpoint_start(models, False) )
+
+
+class MartRouter(object):
+    '''
+    Sends the mart to a database of its own, as a project with a warehouse
+    next to the mart would.
+    '''
+
+    def db_for_write(self, model, **hints):
+        if 'hq_hotel_mart' == model._meta.app_label:
+            return 'mart'
+        return None
+
+
+class ShardTest(SimpleTestCase):
+
+    @override_settings(HQ_MART_SHARDS=[ 'mart0', 'mart1', 'mart2' ])
+    def test_shard_for(self):
+        self.assertEqual(['mart0', 'mart1', 'mart2'], shards.shard_aliases())
+        self.assertEqual('mart0', shards.shard_for(0))
+        self.assertEqual('mart1', shards.shard_for(7))
+        self.assertEqual('mart2', shards.shard_for('8'))
+        self.assertEqual('mart0', shards.shard_for(999))
+
+    @override_settings(HQ_MART_SHARDS=None)
+    def test_shard_for_unsharded(self):
+        self.assertEqual([ None ], shards.shard_aliases())
+        self.assertIsNone(shards.shard_for(7))
+
+    @override_settings( HQ_MART_SHARDS=None
+                      , DATABASE_ROUTERS=[ 'hq_hotel_mart.tests.MartRouter' ] )
+    def test_unsharded_alias_is_routed(self):
+        # transactions and schema changes must follow the routers as well
+        self.assertEqual([ None ], shards.shard_aliases())
+        self.assertEqual('mart', shards.shard_db(None))
+        self.assertEqual('mart', shards.shard_db(None, models.Currency))
+        self.assertEqual('mart1', shards.shard_db('mart1', models.Currency))
+
+    @override_settings(HQ_MART_SHARDS=None)
+    def test_unsharded_alias_without_router(self):
+        self.assertEqual('default', shards.shard_db(None))
+
+
+@override_settings(HQ_MART_SHARDS=[ 'missing', 'default' ])
+class ShardedApiTest(MartTestCase):
+    '''
+    The test mart lives in the default database, the shard of the odd hotels.
+    The even hotels are sent to a database that does not exist.
+    '''
+    query = ( 'queryAt=2016-01-02T10&hotelId=%i'
+            + '&checkinDate=2016-01-03&checkoutDate=2016-01-05' )
+
+    def test_query_goes_to_hotel_shard(self):
+        data = self.api_data(self.query % 7)
+        self.assertEqual(Decimal(102), Decimal(data['sellingPrice']))
+        self.assertEqual(['default'], list(views.HOURS))
+        self.assertEqual(['default'], list(views.GENERATIONS))
+
+    def test_query_never_reads_other_shard(self):
+        with self.assertRaises(ConnectionDoesNotExist):
+            self.api(self.query % 8)
+
+    def test_calendar_goes_to_hotel_shard(self):
+        data = self.api_data( 'queryAt=2016-01-02T10&hotelId=7&nights=2'
+                              '&fromDate=2016-01-03&toDate=2016-01-05'
+                            , views.CalendarView )
+        self.assertTrue(data)
+        self.assertEqual(['default'], list(views.GENERATIONS))
+        with self.assertRaises(ConnectionDoesNotExist):
+            self.api( 'queryAt=2016-01-02T10&hotelId=8&nights=2'
+                      '&fromDate=2016-01-03&toDate=2016-01-05'
+                    , views.CalendarView )
+
+
+class BloomFilterTest(SimpleTestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter.for_items(range(0, 20000, 2), 0.01)
+        self.assertTrue(all(i in bloom for i in range(0, 20000, 2)))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter.for_items(range(0, 20000, 2), 0.01)
+        false = sum(1 for i in range(1, 20000, 2) if i in bloom)
+        self.assertLess(false, 10000 * 0.02)
+
+    def test_round_trip(self):
+        bloom = BloomFilter.for_items([ 3 , 5 , 8 ], 0.01)
+        copy = BloomFilter(bloom.size, bloom.hashes, bloom.to_bytes())
+        self.assertIn(5, copy)
+        self.assertEqual(bloom.to_bytes(), copy.to_bytes())
+
+
+class StatsTest(SimpleTestCase):
+
+    def test_sketch_never_underestimates(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        for hotel in range(500):
+            sketch.add(hotel, hotel % 7)
+        self.assertTrue(all( sketch.estimate(hotel) >= hotel % 7
+                             for hotel in range(500) ))
+
+    def test_heavy_hotels(self):
+        stats = ReloadStats(top=3)
+        for hotel in range(100):
+            rows = 1000 if hotel in (13, 42, 77) else 10
+            for hour in range(rows):
+                stats.hotel_offer(hotel, hour)
+        results = stats.results()
+        self.assertEqual( set([ 13 , 42 , 77 ])
+                        , set(h['hotelId'] for h in results['heavyHotels']) )
+        self.assertEqual(1000, results['rowsPerHour']['count'])
+        self.assertEqual(3970, results['totals']['hotelOffers'])
+
+    def test_histogram_buckets(self):
+        histogram = Histogram()
+        for value in (0, 1, 3, 3, 4, 1000):
+            histogram.add(value)
+        data = histogram.to_dict()
+        self.assertEqual( [ [ 0 , 1 , 1 ] , [ 1 , 2 , 1 ] , [ 2 , 4 , 2 ]
+                          , [ 4 , 8 , 1 ] , [ 512 , 1024 , 1 ] ]
+                        , data['buckets'] )
+        self.assertEqual(1000, data['max'])
+
+
+class FileSourceTest(SimpleTestCase):
+    header = ( 'id,hotel_id,price_usd,original_price,original_currency'
+             + ',breakfast_included,valid_from_date,valid_to_date'
+             + ',valid_from_time,valid_to_time,checkin_date,checkout_date'
+             + ',invalid\n' )
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.write('currencies.csv', 'code,name\nUSD,Dollar\nEUR,Euro\n')
+        # ids keep growing from a file to the next, 4 is not valid
+        self.write('offers-1.csv', self.header + ''.join(
+            self.offer(i, 'EUR' if i % 2 else 'USD') for i in (1, 2, 3)))
+        self.write('offers-2.csv', self.header + ''.join(
+            self.offer(i, 'USD', i == 4) for i in (4, 5)))
+
+    def write(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def offer(self, pk, code, invalid=False):
+        return ( '%i,7,100,%s,%s,t,2016-01-01,2016-01-02,00:00:00,23:00:00'
+                 ',2016-01-03,2016-01-05,%s\n'
+               % (pk, 50 if 'EUR' == code else 100, code, invalid) )
+
+    def test_chunks_and_resume(self):
+        source = get_source('csv:' + self.path)
+        chunks = list(source.offer_chunks(0, 2))
+        self.assertEqual( [ [ 1 , 2 ] , [ 3 , 5 ] ]
+                        , [ [ o.pk for o in c ] for c in chunks ] )
+        offer = chunks[0][0]
+        self.assertEqual(Decimal(50), offer.original_price)
+        self.assertEqual('EUR', offer.currency_code)
+        self.assertTrue(offer.breakfast_included)
+        self.assertEqual(datetime.time(23), offer.valid_to_time)
+        self.assertEqual(datetime.date(2016, 1, 3), offer.checkin_date)
+        resumed = list(source.offer_chunks(2, 10))
+        self.assertEqual([ 3 , 5 ], [ o.pk for o in resumed[0] ])
+
+    def test_currencies_and_rates(self):
+        source = FileSource(self.path)
+        self.assertEqual( [ 'USD' , 'EUR' ]
+                        , [ c.code for c in source.currencies() ] )
+        sums = source.rate_sums()
+        self.assertEqual((Decimal(100), Decimal(200)), sums['EUR'])
+        self.assertEqual((Decimal(200), Decimal(200)), sums['USD'])
+
+    def test_bad_sources(self):
+        with self.assertRaises(ValueError):
+            get_source('csv:' + os.path.join(self.path, 'missing'))
+        with self.assertRaises(ValueError):
+            get_source('ftp:somewhere')
@@ -41,6 +41,14 @@ urlpatterns = [
          , views.ApiView.as_view()
          , name='api'
          )
+    , url( r'^calendar/$'
+         , views.CalendarView.as_view()
+         , name='calendar'
+         )
+    , url( r'^stats/$'
+         , views.StatsView.as_view()
+         , name='stats'
+         )
     , url( r''
          , views.DocView.as_view()
          , name='doc'
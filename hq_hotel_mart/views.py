@@ -3,17 +3,128 @@ from django import http
 from django.views import generic
 from django.conf import settings
 
-import datetime
+import datetime, json, time
+from decimal import Decimal
 
 from . import models
+from . import shards
+from .bloom import BloomFilter
 from .util import JSONResponseMixin
 
 
+# Every hour loaded in a shard, keyed by shard and then hour key, with the id
+# of the Hour row.  The whole hour table is read at once (a year is under 9000
+# rows) so that no request needs a query to validate its hour.  Read again
+# after HQ_MART_HOUR_CACHE_TTL seconds, hqm-roll adds and removes hours.
+HOURS = {}
+
+def loaded_hours(using):
+    ttl = getattr(settings, 'HQ_MART_HOUR_CACHE_TTL', 600)
+    entry = HOURS.get(using)
+    if not entry or time.time() - entry[1] > ttl:
+        qs = models.Hour.objects.using(using).values_list('pk', 'day', 'hour')
+        hours = dict( (models.hour_key(day, hour), pk)
+                      for pk, day, hour in qs.iterator() )
+        entry = (hours, time.time())
+        HOURS[using] = entry
+    return entry[0]
+
+
+# The generation the API reads, keyed by shard, None when no reload has been
+# published yet.  A worker notices a newly published generation at most
+# HQ_MART_GENERATION_TTL seconds late, hqm-gc keeps the previous generation
+# around for longer than that.
+GENERATIONS = {}
+
+def current_generation(using):
+    ttl = getattr(settings, 'HQ_MART_GENERATION_TTL', 10)
+    entry = GENERATIONS.get(using)
+    if not entry or time.time() - entry[1] > ttl:
+        qs = models.Generation.objects.using(using).filter(
+            published__isnull=False)
+        number = qs.order_by('-number').values_list('number', flat=True)
+        entry = (number.first(), time.time())
+        GENERATIONS[using] = entry
+    return entry[0]
+
+
+# Bloom filters of the hotels present in an hour, keyed by shard, generation
+# and hour id, None when the hour has no filter.  Expire after
+# HQ_MART_PRESENCE_TTL seconds, hqm-roll adds hours without filters and we
+# must notice when a reload gives them one.
+PRESENCE = {}
+
+def hotel_absent(using, generation, hour_id, hotel_id):
+    '''
+    True only when the hotel certainly has no offers in the hour.
+    '''
+    ttl = getattr(settings, 'HQ_MART_PRESENCE_TTL', 60)
+    entry = PRESENCE.get((using, generation, hour_id))
+    if not entry or time.time() - entry[1] > ttl:
+        if len(PRESENCE) >= getattr(settings, 'HQ_MART_PRESENCE_CACHE', 48):
+            PRESENCE.clear()
+        qs = models.HotelPresence.objects.using(using)
+        row = qs.filter(generation=generation, hour_id=hour_id).first()
+        bloom = None
+        if row:
+            bloom = BloomFilter(row.size, row.hashes, row.bits)
+        entry = (bloom, time.time())
+        PRESENCE[(using, generation, hour_id)] = entry
+    bloom = entry[0]
+    return bloom is not None and hotel_id not in bloom
+
+def cache_presence(using, generation, hour_ids):
+    '''
+    Loads the filters of several hours at once, hours without a filter are
+    cached as unknown.
+    '''
+    filters = dict.fromkeys(hour_ids)
+    qs = models.HotelPresence.objects.using(using).filter(
+        generation=generation, hour__in=hour_ids)
+    for row in qs:
+        filters[row.hour_id] = BloomFilter(row.size, row.hashes, row.bits)
+    now = time.time()
+    for hour_id, bloom in filters.items():
+        PRESENCE[(using, generation, hour_id)] = (bloom, now)
+
+
+# Exchange rates (units per usd) keyed by shard, then by currency code.  The
+# whole table is a few hundred rows at most, it is read in one go and kept
+# for HQ_MART_RATE_TTL seconds.
+RATES = {}
+
+def exchange_rates(using):
+    ttl = getattr(settings, 'HQ_MART_RATE_TTL', 600)
+    entry = RATES.get(using)
+    if not entry or time.time() - entry[1] > ttl:
+        qs = models.ExchangeRate.objects.using(using).values_list(
+            'currency__code', 'per_usd')
+        entry = (dict(qs), time.time())
+        RATES[using] = entry
+    return entry[0]
+
+def get_arg(request, *names):
+    '''
+    The value of the first of the names given in the query string, the API
+    is forgiving with argument naming.
+    '''
+    for name in names:
+        value = request.GET.get(name)
+        if value:
+            return value
+    return None
+
 class DocView(generic.TemplateView):
     template_name = 'hq_hotel_mart/doc.html'
 
 
 class HqHotelMartListView(generic.ListView):
+    '''
+    Browsing pages, not the API.  These and the detail views below are not
+    sharded, they read the database the routers pick for the mart.  With
+    HQ_MART_SHARDS set that database holds the offers of one shard at most,
+    the other shards are not listed.
+    '''
     template_name = 'hq_main/list.html'
     context_object_name = 'object_list'
     paginate_by = 12  # I just like the number 12
@@ -25,6 +136,7 @@ class CurrencyListView(HqHotelMartListView):
 
 class OfferListView(HqHotelMartListView):
     model = models.Offer
+    queryset = models.Offer.objects.select_related('original_currency')
 
 
 class HourListView(HqHotelMartListView):
@@ -33,6 +145,8 @@ class HourListView(HqHotelMartListView):
 
 class HotelOfferListView(HqHotelMartListView):
     model = models.HotelOffer
+    # __str__ follows the hour, the templates follow the offer
+    queryset = models.HotelOffer.objects.select_related('hour', 'offer_id')
 
 
 class CurrencyView(generic.DetailView):
@@ -43,6 +157,7 @@ class CurrencyView(generic.DetailView):
 
 class OfferView(generic.DetailView):
     model = models.Offer
+    queryset = models.Offer.objects.select_related('original_currency')
     template_name = 'hq_hotel_mart/offer.html'
     context_object_name = 'offer'
 
@@ -55,14 +170,23 @@ class HourView(generic.DetailView):
 
 class HotelOfferView(generic.DetailView):
     model = models.HotelOffer
+    queryset = models.HotelOffer.objects.select_related('hour', 'offer_id')
     template_name = 'hq_hotel_mart/hotel_offer.html'
     context_object_name = 'hotel_offer'
 
 
-class HotelOfferView(generic.DetailView):
-    model = models.HotelOffer
-    template_name = 'hq_hotel_mart/hotel_offer.html'
-    context_object_name = 'hotel_offer'
+class StatsView(JSONResponseMixin, generic.View):
+    '''
+    The statistics collected by the last reload, by shard and name.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        context = {}
+        for alias in shards.shard_aliases():
+            qs = models.MartStat.objects.using(alias).order_by('name')
+            context[alias or 'default'] = dict(
+                (stat.name, json.loads(stat.data)) for stat in qs )
+        return self.render_to_response(context)
 
 
 class ApiView(JSONResponseMixin, generic.View):
@@ -84,19 +208,13 @@ class ApiView(JSONResponseMixin, generic.View):
 
         *   check into a hotel for zero or negative number of days
         *   query an offer in the past (query_at after check dates)
+        *   ask for prices in a currency we have no exchange rate for
         '''
-        query_at = (  request.GET.get('queryAt')
-                   or request.GET.get('queryat')
-                   or request.GET.get('query_at') )
-        hotel_id = (  request.GET.get('hotelId')
-                   or request.GET.get('hotelid')
-                   or request.GET.get('hotel_id') )
-        checkin = (  request.GET.get('checkinDate')
-                  or request.GET.get('checkindate')
-                  or request.GET.get('checkin_date') )
-        checkout = (  request.GET.get('checkoutDate')
-                   or request.GET.get('checkoutdate')
-                   or request.GET.get('checkout_date') )
+        query_at, hotel_id = self.query_args(request)
+        checkin = get_arg( request
+                         , 'checkinDate', 'checkindate', 'checkin_date' )
+        checkout = get_arg( request
+                          , 'checkoutDate', 'checkoutdate', 'checkout_date' )
         if not query_at or not hotel_id or not checkin or not checkout:
             return http.HttpResponseBadRequest()  # 400
         try:
@@ -122,17 +240,47 @@ class ApiView(JSONResponseMixin, generic.View):
             return context
         return self.render_to_response(context)
 
+    def query_args(self, request):
+        '''
+        The arguments of every API query: the hour of the query and the hotel,
+        returned as they are, and the currency, kept upper cased.
+        '''
+        currency = get_arg( request
+                          , 'currency', 'currencyCode', 'currencycode'
+                          , 'currency_code' )
+        self.currency = currency and currency.upper()
+        return ( get_arg(request, 'queryAt', 'queryat', 'query_at')
+               , get_arg(request, 'hotelId', 'hotelid', 'hotel_id')
+               )
+
     def get_context_data(self, *args, **kwargs):
         '''
         Queries the database for records.  It performs as little number of
-        queries as it can, but sometimes we do as many as three.
+        queries as it can, but sometimes we do as many as six (three once the
+        caches of the worker are filled).
 
-        First we do a trivial sanity query, in SQL terms:
+        The hour of the query is turned into its hour key (hours since the
+        epoch, see models.hour_key) by plain arithmetic.  The worker keeps the
+        keys of all hours loaded in the mart, a key it does not know is out
+        of range.  That cache is filled by one query over the hour table:
 
-            SELECT COUNT(*)
+            SELECT id, day, hour
             FROM hq_hotel_mart_hour
-            WHERE day  = self.query_at.date()
-            AND   hour = self.query_at.time().hour
+
+        Every query reads the rows of a single generation, the newest one
+        published (see Generation), so a reload running at the same time is
+        invisible until it has loaded everything.  The worker caches that
+        number as well:
+
+            SELECT number
+            FROM hq_hotel_mart_generation
+            WHERE published IS NOT NULL
+            ORDER BY number DESC
+            LIMIT 1
+
+        Then we check the Bloom filter of the hotels present in that hour (see
+        HotelPresence), a hotel without offers in that hour gets the mock
+        answer below without any further query.
 
         If we have data for that hour we try an exact match (from now on we
         assume that all tables are prepended with hq_hotel_mart_), in SQL
@@ -160,9 +308,8 @@ class ApiView(JSONResponseMixin, generic.View):
             FROM hotel_offer
                , currency
                , offer
-               , hour
-            -- We already have hour.id from the previous query
-            WHERE hotel_offer.hour        = <hour.id>
+            WHERE hotel_offer.generation  = <generation>
+            AND   hotel_offer.hour_key    = <hour key>
             AND   hotel_offer.offer_id    = offer.id
             AND   offer.original_currency = currency.id
             -- And here we match
@@ -173,81 +320,314 @@ class ApiView(JSONResponseMixin, generic.View):
             ORDER BY offer.price_usd ASC
             LIMIT 1
 
-        If we cannot match anything we try some fuzzy matching, something like:
+        If we cannot match anything we look for the offer with the same number
+        of days and the nearest check-in date, first after and then before the
+        requested one, something like:
 
             SELECT offer.id
                  -- the SELECT part is absolutely the same as above
             FROM hotel_offer
                , currency
                , offer
-               , hour
-            -- We already have hour.id from the previous query
-            WHERE hotel_offer.hour        = <hour.id>
+            WHERE hotel_offer.generation  = <generation>
+            AND   hotel_offer.hour_key    = <hour key>
             AND   hotel_offer.offer_id    = offer.id
             AND   offer.original_currency = currency.id
             -- And here we match (this is different from the previous query)
-            AND   hotel_hour.days     = <self.days>
-            AND   offer.hotel_id      = <self.hotel_id>
-            -- Finally the order by gets us the cheapest offer
-            ORDER BY offer.price_usd ASC
+            AND   hotel_hour.hotel_id      = <self.hotel_id>
+            AND   hotel_hour.days          = <self.days>
+            AND   hotel_hour.checkin_date  > <self.checkin>
+            AND   hotel_hour.checkin_date <= <self.checkin + N days>
+            -- The nearest date, and the cheapest offer on that date
+            ORDER BY hotel_hour.checkin_date ASC, offer.price_usd ASC
             LIMIT 1
 
+        Both probes walk the (generation, hour_key, hotel_id, days,
+        checkin_date) index from the requested date outward and stop at the
+        first date found, or after N (HQ_MART_FUZZY_DAYS) days, so their cost
+        does not grow with the number of offers of the hotel.  The probe
+        before the requested date never looks further than the date found
+        after it.
+
         Otherwise we just mock an answer.  In reality we should have some
         standard fares for each hotel.
+
+        All queries go to the shard holding the hotel, every shard has its own
+        copy of the hour and currency tables.
         '''
         # generic.View has no get_context_data, do not call super
-        try:
-            # We need to check if this is a query valid for what times we have
-            # loaded in the mart.  This is a trivial query.
-            hour = models.Hour.objects.get( day=self.query_at.date()
-                                          , hour=self.query_at.time().hour )
-        except models.Hour.DoesNotExist:
+        self.using = shards.shard_for(self.hotel_id)
+        if self.currency and self.currency not in exchange_rates(self.using):
+            return http.HttpResponseBadRequest()  # 400
+        hour_id = self.get_hour()
+        if hour_id is None:
             # Don't bother (also, need a better json constructor for this)
             err = { 'error' : 'Time query not in range' }
             return http.HttpResponseNotFound(str(err)+'\n')  # 404
-        # And now the difficult query, build a queryset don't query yet
-        qs = hour.hotel_offers.filter(hotel_id=self.hotel_id)
+        self.generation = current_generation(self.using)
+        if self.generation is None:
+            # Nothing published yet, no offers to look for
+            return self.mock_context()
+        if hotel_absent( self.using, self.generation
+                       , hour_id, self.hotel_id ):
+            return self.mock_context()
         # Try a full match
-        exact_qs = qs.filter( hotel_id=self.hotel_id
-                            , offer_id__checkin_date=self.checkin
-                            , offer_id__checkout_date=self.checkout
-                            ).order_by('offer_id__price_usd')
-        match = exact_qs.select_related().first()  # Query the DB!
+        match = self.exact_queryset().first()  # Query the DB!
         if not match:
             # OK, we got nothing, let's try some fuzzy matching.
             # We try to find an offer that is valid during the moment the query
-            # is made and for the correct number of days.  The assumption here
-            # is that hotels would define a standard rate as an offer that is
-            # valid always, but the check-in and check-out dates would not
-            # match.  (This is probably wrong, but it is nice heuristic)
-            fuzzy_qs = qs.filter( hotel_id=self.hotel_id
-                                , days=self.days
-                                ).order_by('offer_id__price_usd')
-            match = fuzzy_qs.select_related().first()  # Try this query
+            # is made, for the correct number of days and for the check-in
+            # nearest to the requested one.  A stay a day or two earlier or
+            # later is what a guest would most likely accept instead.
+            match = self.nearest_match()
         if match:
             cin = match.offer_id.checkin_date.strftime('%Y-%m-%d')
             cout = match.offer_id.checkout_date.strftime('%Y-%m-%d')
+            offer = match.offer_id
+            price, code = self.selling_price( offer.original_price
+                                            , offer.original_currency.code
+                                            , offer.price_usd )
             context = {
                   'offerId'      : match.offer_id.id
                 , 'hotelId'      : self.hotel_id
                 , 'checkinDate'  : cin
                 , 'checkoutDate' : cout
-                , 'sellingPrice' : match.offer_id.original_price
-                , 'currencyCode' : match.offer_id.original_currency.code
+                , 'sellingPrice' : price
+                , 'currencyCode' : code
                 }
             return context
+        return self.mock_context()
+
+    def mock_context(self):
         # We cannot find anything!  In the real world we should have data from
         # the hotels to check standard fares.  But we do not have such data.
         # Instead, mock a standard price per day:
         cin = self.checkin.strftime('%Y-%m-%d')
         cout = self.checkout.strftime('%Y-%m-%d')
+        price, code = self.standard_fare()
         context = {
               'offerId'      : None
             , 'hotelId'      : self.hotel_id
             , 'checkinDate'  : cin
             , 'checkoutDate' : cout
-            , 'sellingPrice' : settings.HQ_DW_DAY_PRICE * self.days
-            , 'currencyCode' : settings.HQ_DW_DEFAULT_CURRECNY
+            , 'sellingPrice' : price
+            , 'currencyCode' : code
             }
         return context
 
+    def standard_fare(self):
+        # a standard price per day, converted as any other price
+        return self.selling_price( settings.HQ_DW_DAY_PRICE * self.days
+                                 , settings.HQ_DW_DEFAULT_CURRECNY )
+
+    def selling_price(self, price, code, price_usd=None):
+        '''
+        The price in the currency requested, or as it is when no currency was
+        requested.  A requested currency always gets its price rounded to
+        cents, converted or not.  The conversion goes through usd, offers carry
+        their usd price already.  The rates come from the worker's cache, a
+        conversion costs no query.
+        '''
+        if not self.currency:
+            return price, code
+        cents = Decimal('0.01')
+        if self.currency == code:
+            return Decimal(price).quantize(cents), code
+        rates = exchange_rates(self.using)
+        if price_usd is None:
+            if code not in rates:
+                # no way to convert, better the right price in another currency
+                return Decimal(price).quantize(cents), code
+            price_usd = Decimal(price) / rates[code]
+        price = price_usd * rates[self.currency]
+        return price.quantize(cents), self.currency
+
+    def hour_key(self):
+        return models.hour_key(self.query_at.date(), self.query_at.time().hour)
+
+    def get_hour(self):
+        '''
+        We need to check if this is a query valid for what times we have
+        loaded in the mart.  Returns the id of the hour, None when the hour is
+        not loaded.  No query unless the hours of the worker are stale.
+        '''
+        return loaded_hours(self.using).get(self.hour_key())
+
+    # The querysets are built separately from get_context_data so that the
+    # plans of the exact same queries can be checked in the tests.
+
+    def offers_queryset(self):
+        return models.HotelOffer.objects.using(self.using).filter(
+              generation=self.generation
+            , hour_key=self.hour_key()
+            , hotel_id=self.hotel_id
+            )
+
+    def exact_queryset(self):
+        qs = self.offers_queryset().filter(
+              offer_id__checkin_date=self.checkin
+            , offer_id__checkout_date=self.checkout
+            )
+        return qs.order_by('offer_id__price_usd').select_related()
+
+    def fuzzy_queryset(self, after, days):
+        '''
+        Offers of the same length within `days` of the requested check-in,
+        either `after` or before it, nearest first.
+        '''
+        qs = self.offers_queryset().filter(days=self.days)
+        if after:
+            # no further than the last date python knows
+            last = self.checkin + min(days, datetime.date.max - self.checkin)
+            qs = qs.filter( checkin_date__gt=self.checkin
+                          , checkin_date__lte=last )
+            order = 'checkin_date'
+        else:
+            # do not offer a check-in in the past
+            days = min(days, self.checkin - self.query_at.date())
+            first = self.checkin - days
+            qs = qs.filter( checkin_date__lt=self.checkin
+                          , checkin_date__gte=first )
+            order = '-checkin_date'
+        return qs.order_by(order, 'offer_id__price_usd').select_related()
+
+    def nearest_match(self):
+        days = datetime.timedelta(
+            days=getattr(settings, 'HQ_MART_FUZZY_DAYS', 7))
+        after = self.fuzzy_queryset(True, days).first()
+        if after:
+            days = after.checkin_date - self.checkin
+        before = self.fuzzy_queryset(False, days).first()
+        if not before:
+            return after
+        if not after:
+            return before
+        if self.checkin - before.checkin_date < days:
+            return before
+        # equally near, the cheaper wins
+        if before.offer_id.price_usd < after.offer_id.price_usd:
+            return before
+        return after
+
+
+class CalendarView(ApiView):
+    '''
+    The cheapest offer of a hotel for every check-in date of a range, for a
+    stay of the same number of nights, as a calendar widget shows them.  One
+    API query per date would be up to three database queries each, here a
+    single query reads the whole range:
+
+        SELECT ...  -- the same as the exact match of the API
+        FROM hotel_offer
+           , currency
+           , offer
+        WHERE hotel_offer.generation   = <generation>
+        AND   hotel_offer.hour_key     = <hour key>
+        AND   hotel_offer.hotel_id     = <self.hotel_id>
+        AND   hotel_offer.days         = <self.days>
+        AND   hotel_offer.checkin_date BETWEEN <self.first> AND <self.last>
+        AND   hotel_offer.offer_id     = offer.id
+        AND   offer.original_currency  = currency.id
+        ORDER BY hotel_offer.checkin_date ASC, offer.price_usd ASC
+
+    It walks a single range of the API index, the first row of each date is
+    its cheapest offer.  Dates without an offer get the mock answer of the
+    API, there is no fuzzy matching: a nearby date is in the calendar anyway.
+    '''
+
+    def get(self, request, *args, **kwargs):
+        '''
+        The same arguments as the API, but `nights` and the range of check-in
+        dates, `fromDate` and `toDate` (both included), instead of the check-in
+        and check-out dates.  The range may not be longer than
+        HQ_MART_CALENDAR_DAYS days, nor the stays than HQ_MART_CALENDAR_NIGHTS
+        nights, and the last check-out must be a date python can count to.
+        '''
+        query_at, hotel_id = self.query_args(request)
+        nights = get_arg(request, 'nights', 'days')
+        first = get_arg(request, 'fromDate', 'fromdate', 'from_date')
+        last = get_arg(request, 'toDate', 'todate', 'to_date')
+        if not query_at or not hotel_id or not nights or not first or not last:
+            return http.HttpResponseBadRequest()  # 400
+        try:
+            # all these raise value error
+            self.query_at = datetime.datetime.strptime(query_at, '%Y-%m-%dT%H')
+            self.hotel_id = int(hotel_id)
+            self.days = int(nights)
+            dt = datetime.datetime.strptime(first, '%Y-%m-%d')
+            self.first = dt.date()
+            dt = datetime.datetime.strptime(last, '%Y-%m-%d')
+            self.last = dt.date()
+        except ValueError:
+            return http.HttpResponseBadRequest()  # 400
+        # Sanity checks
+        if 0 >= self.days or self.first > self.last:
+            return http.HttpResponseBadRequest()  # 400
+        if self.first < self.query_at.date():
+            return http.HttpResponseBadRequest()  # 400
+        span = (self.last - self.first).days + 1
+        if span > getattr(settings, 'HQ_MART_CALENDAR_DAYS', 62):
+            return http.HttpResponseBadRequest()  # 400
+        if self.days > getattr(settings, 'HQ_MART_CALENDAR_NIGHTS', 30):
+            return http.HttpResponseBadRequest()  # 400
+        if (datetime.date.max - self.last).days < self.days:
+            # the check-out of the last date would overflow
+            return http.HttpResponseBadRequest()  # 400
+        context = self.get_context_data()
+        if not dict == type(context):
+            # This is an HTTP response!  Dump it back
+            return context
+        return self.render_to_response(context)
+
+    def get_context_data(self, *args, **kwargs):
+        # generic.View has no get_context_data, do not call super
+        self.using = shards.shard_for(self.hotel_id)
+        if self.currency and self.currency not in exchange_rates(self.using):
+            return http.HttpResponseBadRequest()  # 400
+        hour_id = self.get_hour()
+        if hour_id is None:
+            err = { 'error' : 'Time query not in range' }
+            return http.HttpResponseNotFound(str(err)+'\n')  # 404
+        self.generation = current_generation(self.using)
+        cheapest = {}
+        if ( self.generation is not None
+             and not hotel_absent( self.using, self.generation
+                                 , hour_id, self.hotel_id ) ):
+            for match in self.calendar_queryset():  # Query the DB!
+                cheapest.setdefault(match.checkin_date, match)
+        dl = datetime.timedelta(days=1)
+        days = []
+        checkin = self.first
+        while checkin <= self.last:
+            days.append(self.day_context(checkin, cheapest.get(checkin)))
+            checkin += dl
+        return { 'hotelId' : self.hotel_id
+               , 'nights'  : self.days
+               , 'days'    : days
+               }
+
+    def day_context(self, checkin, match):
+        checkout = checkin + datetime.timedelta(days=self.days)
+        if match:
+            offer = match.offer_id
+            price, code = self.selling_price( offer.original_price
+                                            , offer.original_currency.code
+                                            , offer.price_usd )
+        else:
+            # the mock answer of the API
+            price, code = self.standard_fare()
+        return { 'offerId'      : match.offer_id.id if match else None
+               , 'checkinDate'  : checkin.strftime('%Y-%m-%d')
+               , 'checkoutDate' : checkout.strftime('%Y-%m-%d')
+               , 'sellingPrice' : price
+               , 'currencyCode' : code
+               }
+
+    def calendar_queryset(self):
+        qs = self.offers_queryset().filter(
+              days=self.days
+            , checkin_date__gte=self.first
+            , checkin_date__lte=self.last
+            )
+        qs = qs.order_by('checkin_date', 'offer_id__price_usd')
+        return qs.select_related()
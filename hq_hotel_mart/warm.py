@@ -0,0 +1,109 @@
+import datetime, logging
+
+from django.conf import settings
+from django.core.urlresolvers import get_resolver
+from django.db import DatabaseError
+from django.template.loader import get_template
+from django.test import RequestFactory
+
+from . import models
+from . import shards
+from . import views
+
+
+logger = logging.getLogger(__name__)
+
+# Templates rendered by the mart views, compiled ahead of the first request
+TEMPLATES = [ 'hq_hotel_mart/doc.html'
+            , 'hq_hotel_mart/currency.html'
+            , 'hq_hotel_mart/offer.html'
+            , 'hq_hotel_mart/hour.html'
+            , 'hq_hotel_mart/hotel_offer.html'
+            ]
+
+
+def hour_window(start, ahead):
+    '''
+    The (day, hour) pairs from `start` up to `ahead` hours later, inclusive.
+    '''
+    start = start.replace(minute=0, second=0, microsecond=0)
+    dl = datetime.timedelta(hours=1)
+    return [ start + dl * i for i in range(ahead + 1) ]
+
+def warm_hours(start, ahead):
+    '''
+    Preloads the API hour cache of this process, the generation it reads, the
+    hotel presence filters of the hours from `start` to `ahead` hours later
+    and the exchange rates, four queries per shard.  Returns the keys of those
+    hours found loaded, per shard.
+    '''
+    window = [ models.hour_key(dt.date(), dt.time().hour)
+               for dt in hour_window(start, ahead) ]
+    found = {}
+    for alias in shards.shard_aliases():
+        hours = views.loaded_hours(alias)
+        found[alias] = [ key for key in window if key in hours ]
+        generation = views.current_generation(alias)
+        views.cache_presence( alias, generation
+                            , [ hours[key] for key in found[alias] ] )
+        views.exchange_rates(alias)
+    return found
+
+def touch_hours(found):
+    '''
+    Reads the hour cache rows of the given hour keys, in the generation the
+    API reads, through the same index the API uses, together with their
+    offers.  That pulls the index and table pages into the database buffers.
+    The rows are counted and summed on the server, none comes back to us.
+    Returns the number of rows read per shard.
+    '''
+    from django.db.models import Count, Sum
+
+    touched = {}
+    for alias, keys in found.items():
+        qs = models.HotelOffer.objects.using(alias).filter(
+            generation=views.current_generation(alias), hour_key__in=keys)
+        totals = qs.aggregate( rows=Count('pk')
+                             , price=Sum('offer_id__price_usd') )
+        touched[alias] = totals['rows']
+    return touched
+
+def replay_queries(lines):
+    '''
+    Runs recorded API queries through ApiView in this process.  Each line is a
+    query string (`queryAt=...&hotelId=...`) or a full URL, empty lines and
+    lines starting with `#` are ignored.  Yields the query and status code.
+    '''
+    factory = RequestFactory()
+    view = views.ApiView.as_view()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        query = line.split('?', 1)[-1]
+        response = view(factory.get('/api/?' + query))
+        yield query, response.status_code
+
+def warm_worker(start=None, ahead=None):
+    '''
+    Makes a freshly started API worker ready to serve at full speed: builds
+    the URL resolver, compiles the templates and fills the hour cache around
+    `start` (default now).  Call it from the application server's worker
+    start hook, e.g. gunicorn's post_worker_init, once the worker is forked:
+    a connection opened before the fork would be shared by all workers.
+    '''
+    if start is None:
+        start = datetime.datetime.now()
+    if ahead is None:
+        ahead = getattr(settings, 'HQ_MART_WARM_HOURS', 24)
+    # url_patterns is lazy, reading it imports and compiles the URLconf
+    resolver = get_resolver()
+    resolver.url_patterns
+    for name in TEMPLATES:
+        get_template(name)
+    try:
+        return warm_hours(start, ahead)
+    except DatabaseError as e:
+        # Tables missing (e.g. before migrate), the worker will warm lazily
+        logger.warning('cannot warm hours: %s', e)
+        return {}
@@ -29,6 +29,14 @@ REQS = [
 CONSOLE_SCRIPTS = [
       'hqm-reload=hq_hotel_mart.command_line:reload_mart'
     , 'hqm-pop-hours=hq_hotel_mart.command_line:populate_hours'
+    , 'hqm-export=hq_hotel_mart.command_line:export_mart'
+    , 'hqm-import=hq_hotel_mart.command_line:import_mart'
+    , 'hqm-warm=hq_hotel_mart.command_line:warm_mart'
+    , 'hqm-roll=hq_hotel_mart.command_line:roll_mart'
+    , 'hqm-gc=hq_hotel_mart.command_line:gc_mart'
+    , 'hqm-loadtest=hq_hotel_mart.command_line:load_test'
+    , 'hqm-status=hq_hotel_mart.command_line:status_mart'
+    , 'hqm=hq_hotel_mart.command_line:main'
     ]
 
 setup(